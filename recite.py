@@ -25,36 +25,180 @@
 # OF SUCH DAMAGE.
 #######################################################################
 
+import BaseHTTPServer
 import ConfigParser
+import SocketServer
 import StringIO
 import atexit
+import base64
+import collections
+import copy
+import csv
 import getpass
 import glob
+import hashlib
+import httplib
+import json
+import math
 import os
 import os.path
 import pickle
+import random
 import re
+import select
 import shlex
+import shutil
 import signal
 import socket
+import stat
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import types
+import uuid
 import xml.dom.minidom
+import xml.sax.saxutils
+
+try:
+	import xml.etree.cElementTree as ElementTree
+except ImportError:
+	import xml.etree.ElementTree as ElementTree
+
+try:
+	import resource
+except:
+	resource = None
+
+try:
+	import ssl
+except:
+	ssl = None
 
 #try:
 #	import readline
 #except:
 #	pass
 
+###
+# Daemon client - kept ahead of the method catalogs so the client doesn't load them
+
+# Frame types between client and daemon
+FRAME_ARGS = "A"
+FRAME_COMMAND = "C"
+FRAME_OUTPUT = "O"
+FRAME_PROMPT = "P"
+FRAME_RETURN = "R"
+FRAME_HEADER = "!cI"
+
+def sendframe(sock, kind, data=""):
+	sock.sendall(struct.pack(FRAME_HEADER, kind, len(data)) + data)
+
+# Returns (type, data) or (None, None) if the other end closed the connection
+def recvframe(sock):
+	header = recvexact(sock, struct.calcsize(FRAME_HEADER))
+	if header == None:
+		return None, None
+	kind, size = struct.unpack(FRAME_HEADER, header)
+	data = recvexact(sock, size)
+	if data == None:
+		return None, None
+	return kind, data
+
+def recvexact(sock, size):
+	data = []
+	while size:
+		chunk = sock.recv(min(size, 65536))
+		if not chunk:
+			return None
+		data.append(chunk)
+		size -= len(chunk)
+	return "".join(data)
+
+# Forward the command line to a running daemon, print its output as it arrives
+#   recite.py --client /path/to.sock IP=... "GetRSStatus" -q
+def client(cmdline=sys.argv):
+	cmdline = cmdline[1:]
+	i = cmdline.index("--client")
+	if i + 1 >= len(cmdline):
+		print "Usage: recite.py --client /path/to.sock [arguments]"
+		return 2
+	path = cmdline[i + 1]
+	cmdline = cmdline[:i] + cmdline[i + 2:]
+
+	# Scripts are opened by the daemon, which may be running elsewhere
+	for i in range(len(cmdline)):
+		if os.path.isfile(cmdline[i]):
+			cmdline[i] = os.path.abspath(cmdline[i])
+
+	# IP from the client environment, not the daemon's
+	ip = os.getenv("IP")
+	if ip and not len([i for i in cmdline if i[:3] == "IP="]):
+		cmdline.append("IP=%s" % ip)
+
+	try:
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.connect(path)
+	except Exception, e:
+		print "Unable to connect to %s: %s" % (path, e)
+		return 2
+
+	ret = "None"
+	try:
+		sendframe(sock, FRAME_ARGS, "\0".join(cmdline))
+		while True:
+			kind, data = recvframe(sock)
+			if kind == None or kind == FRAME_RETURN:
+				if kind != None:
+					ret = data
+				break
+			elif kind == FRAME_OUTPUT:
+				sys.stdout.write(data)
+				sys.stdout.flush()
+			elif kind == FRAME_PROMPT:
+				# Interactive mode runs over the socket
+				try:
+					cmd = raw_input("--> ")
+				except EOFError:
+					cmd = "quit"
+				sendframe(sock, FRAME_COMMAND, cmd.replace("\\", "\\\\"))
+	except KeyboardInterrupt:
+		pass
+	sock.close()
+
+	if ret == "False":
+		return 1
+	return 0
+
+if __name__ == "__main__" and "--client" in sys.argv:
+	sys.exit(client())
+
 # Defaults
 LOGINDEFAULT = "root"
 PASSDEFAULT = "calvin"
 PORTDEFAULT = 443
 DEVICEDEFAULT = 'idrac'
+POOLSIZEDEFAULT = 4
+POOLIDLEDEFAULT = 60
+PARALLELDEFAULT = 4
+BACKOFFBASE = 1
+BACKOFFMAX = 30
+BREAKERFAILURES = 5
+BREAKERRESET = 60
+TRACEBATCH = 100
+TRACEFLUSH = 5
+METRICBUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+MOCKPORTDEFAULT = 8443
+MOCKBINDDEFAULT = "127.0.0.1"
+MOCKINSTANCESDEFAULT = 5
+MOCKJOBDEFAULT = 30
+BENCHINSTANCES = 3000
+BENCHRANGE = "10.1.0.0-10.1.15.255"
+BENCHSECONDS = 1
+BENCHTOLERANCE = 0.2
+BENCHVARIABLES = 500
 
 # Strings
 NAME = "name"
@@ -64,10 +208,19 @@ PARAMS = "params"
 GETPARAMS = "getparams"
 DEFAULT = "default"
 EXAMPLE = "example"
+ELEMENTS = "elements"
 NORMAL = "normal"
 XML = "xml"
 PRETTY = "prettyxml"
+JSON = "json"
+JSONL = "jsonl"
+CSV = "csv"
+TSV = "tsv"
+DETAIL = "detail"
+DOCUMENT = "#document"
 GLOBAL = "global"
+WSMAN = "wsman"
+NATIVE = "native"
 
 # WS-MAN address contruction
 ADDRESSREF = """  <p:%s xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:w="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd">
@@ -83,6 +236,126 @@ ADDRESSREF = """  <p:%s xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressin
 
 SELECTORREF = '        <w:Selector Name="%s">%s</w:Selector>'
 
+# WS-MAN native envelope construction
+CIMSCHEMA = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/"
+SOAPENV = "http://www.w3.org/2003/05/soap-envelope"
+ANONYMOUS = "http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous"
+ACTION_GET = "http://schemas.xmlsoap.org/ws/2004/09/transfer/Get"
+ACTION_PUT = "http://schemas.xmlsoap.org/ws/2004/09/transfer/Put"
+ACTION_ENUMERATE = "http://schemas.xmlsoap.org/ws/2004/09/enumeration/Enumerate"
+ACTION_PULL = "http://schemas.xmlsoap.org/ws/2004/09/enumeration/Pull"
+
+ENVELOPE = """<?xml version="1.0" encoding="UTF-8"?>
+<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:a="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:n="http://schemas.xmlsoap.org/ws/2004/09/enumeration" xmlns:w="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd">
+  <s:Header>
+    <a:To s:mustUnderstand="true">%s</a:To>
+    <w:ResourceURI s:mustUnderstand="true">%s</w:ResourceURI>
+    <a:ReplyTo>
+      <a:Address s:mustUnderstand="true">%s</a:Address>
+    </a:ReplyTo>
+    <a:Action s:mustUnderstand="true">%s</a:Action>
+    <w:MaxEnvelopeSize s:mustUnderstand="true">512000</w:MaxEnvelopeSize>
+    <a:MessageID s:mustUnderstand="true">uuid:%s</a:MessageID>
+    <w:OperationTimeout>PT60S</w:OperationTimeout>
+%s
+  </s:Header>
+  <s:Body>
+%s
+  </s:Body>
+</s:Envelope>
+"""
+
+IDENTIFY = """<?xml version="1.0" encoding="UTF-8"?>
+<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:wsmid="http://schemas.dmtf.org/wbem/wsman/identity/1/wsmanidentity.xsd">
+  <s:Header/>
+  <s:Body>
+    <wsmid:Identify/>
+  </s:Body>
+</s:Envelope>
+"""
+
+SELECTORSET = """    <w:SelectorSet>
+%s
+    </w:SelectorSet>"""
+
+ENUMERATE = """    <n:Enumerate>
+%s
+    </n:Enumerate>"""
+
+PULL = """    <n:Pull>
+      <n:EnumerationContext>%s</n:EnumerationContext>
+%s
+    </n:Pull>"""
+
+FILTER = '      <w:Filter Dialect="%s">%s</w:Filter>'
+
+ASSOCFILTER = """      <w:Filter Dialect="%s">
+        <b:AssociatedInstances xmlns:b="http://schemas.dmtf.org/wbem/wsman/1/cimbinding.xsd">
+          <b:Object>
+            <a:Address>%s</a:Address>
+            <a:ReferenceParameters>
+              <w:ResourceURI>%s</w:ResourceURI>
+%s
+            </a:ReferenceParameters>
+          </b:Object>
+        </b:AssociatedInstances>
+      </w:Filter>"""
+
+INVOKEINPUT = """<p:%s_INPUT xmlns:p="%s">
+%s</p:%s_INPUT>"""
+
+# Mock server responses
+MOCKENVELOPE = """<?xml version="1.0" encoding="UTF-8"?>
+<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:wsa="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:wsen="http://schemas.xmlsoap.org/ws/2004/09/enumeration" xmlns:wsman="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd" xmlns:n1="%s">
+  <s:Header>
+    <wsa:To>http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous</wsa:To>
+    <wsa:Action>%s</wsa:Action>
+    <wsa:RelatesTo>%s</wsa:RelatesTo>
+    <wsa:MessageID>uuid:%s</wsa:MessageID>
+  </s:Header>
+  <s:Body>
+%s
+  </s:Body>
+</s:Envelope>
+"""
+
+MOCKIDENTIFY = """<?xml version="1.0" encoding="UTF-8"?>
+<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:wsmid="http://schemas.dmtf.org/wbem/wsman/identity/1/wsmanidentity.xsd">
+  <s:Header/>
+  <s:Body>
+    <wsmid:IdentifyResponse>
+      <wsmid:ProtocolVersion>http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd</wsmid:ProtocolVersion>
+      <wsmid:ProductVendor>Recite mock server</wsmid:ProductVendor>
+      <wsmid:ProductVersion>1.0</wsmid:ProductVersion>
+    </wsmid:IdentifyResponse>
+  </s:Body>
+</s:Envelope>
+"""
+
+MOCKEPR = """      <wsa:EndpointReference>
+        <wsa:Address>http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous</wsa:Address>
+        <wsa:ReferenceParameters>
+          <wsman:ResourceURI>%s</wsman:ResourceURI>
+          <wsman:SelectorSet>
+%s
+          </wsman:SelectorSet>
+        </wsa:ReferenceParameters>
+      </wsa:EndpointReference>"""
+
+MOCKSELECTOR = '            <wsman:Selector Name="%s">%s</wsman:Selector>'
+
+MOCKFAULT = """    <s:Fault>
+      <s:Code>
+        <s:Value>s:Sender</s:Value>
+        <s:Subcode>
+          <s:Value>%s</s:Value>
+        </s:Subcode>
+      </s:Code>
+      <s:Reason>
+        <s:Text xml:lang="en">%s</s:Text>
+      </s:Reason>
+    </s:Fault>"""
+
 # XML object generation
 OBJECT = '<obj type="%s" name="%s">%s</obj>'
 
@@ -102,11 +375,18 @@ VAR_COUNT = "$_COUNT"
 FORMAT = "$FORMAT"
 IP = "$IP"
 LOGIN = "$LOGIN"
+MAXELEMENTS = "$MAXELEMENTS"
+PARALLEL = "$PARALLEL"
 PASS = "$PASS"
 DEVICE = "$DEVICE"
 PORT = "$PORT"
 PROGRAM = "$PROGRAM"
+RECORD = "$RECORD"
+REPLAY = "$REPLAY"
+RETRIES = "$RETRIES"
+TIMEOUT = "$TIMEOUT"
 TIMER = "$TIMER"
+TRANSPORT = "$TRANSPORT"
 USLEEP = "$USLEEP"
 UTIMEOUT = "$UTIMEOUT"
 VERBOSE = "$VERBOSE"
@@ -121,11 +401,18 @@ REQ_VARIABLES = [
 	FORMAT,
 	IP,
 	LOGIN,
+	MAXELEMENTS,
+	PARALLEL,
 	PASS,
 	PORT,
 	DEVICE,
 	PROGRAM,
+	RECORD,
+	REPLAY,
+	RETRIES,
+	TIMEOUT,
 	TIMER,
+	TRANSPORT,
 	USLEEP,
 	UTIMEOUT,
 	VERBOSE
@@ -154,6 +441,9 @@ METAMETHODS = [
 # Global data
 BATCH = []
 CACHED_EPR = {}
+PARSED = {}
+PARSEDMAX = 1000
+TEMPLATES = {}
 CONTEXT = None
 GOTO = None
 INPUT = ""
@@ -163,8 +453,43 @@ LOGGER = None
 OUTPUT = ""
 OUTPUTXML = ""
 OUTPUTXMLOBJ = None
+OUTPUTTREE = None
+OUTPUTPAGES = []
+PHASES = {}
 RETURN = []
-TEMPFILES = []
+TIMINGS = {}
+METRICS = None
+
+# Phases of a command shown by $TIMER detail
+TIMERPHASES = [
+	("vars", "variables"),
+	("build", "buildcmd"),
+	("connect", "connect"),
+	("wait", "first byte"),
+	("transfer", "transfer"),
+	("parse", "parse"),
+	("render", "render"),
+	("log", "log")
+]
+
+# Globals private to each session, rest are shared
+SESSION_STATE = [
+	"BATCH",
+	"CONTEXT",
+	"GOTO",
+	"INPUT",
+	"INPUTXML",
+	"LOGGER",
+	"OUTPUT",
+	"OUTPUTXML",
+	"OUTPUTXMLOBJ",
+	"OUTPUTTREE",
+	"OUTPUTPAGES",
+	"PHASES",
+	"RETURN",
+	"VARIABLES"
+]
+
 try:
 	LOCALIP = socket.gethostbyname(socket.gethostname())
 except:
@@ -181,11 +506,18 @@ VARIABLES = {
 	FORMAT: NORMAL,
 	IP: "",
 	LOGIN: os.getenv("LOGIN") or LOGINDEFAULT,
+	MAXELEMENTS: os.getenv("MAXELEMENTS") or "0",
+	PARALLEL: os.getenv("PARALLEL") or PARALLELDEFAULT,
 	PASS: os.getenv("PASS") or PASSDEFAULT,
 	PORT: PORTDEFAULT,
 	DEVICE: DEVICEDEFAULT,
 	PROGRAM: "False",
+	RECORD: os.getenv("RECORD") or "",
+	REPLAY: os.getenv("REPLAY") or "",
+	RETRIES: os.getenv("RETRIES") or "0",
+	TIMEOUT: os.getenv("TIMEOUT") or "0",
 	TIMER: os.getenv("TIMER") or "False",
+	TRANSPORT: os.getenv("TRANSPORT") or WSMAN,
 	USLEEP: os.getenv("USLEEP") or "30",
 	UTIMEOUT: os.getenv("UTIMEOUT") or "900",
 	VERBOSE: VERBOSE_INIT,
@@ -330,6 +662,21 @@ INTERNAL = {
 		"  Log"
 	],
 
+	"Parallel": [
+		"Run the commands up to EndParallel at the same time, batch mode only",
+		"Output, variables and return codes are combined in line order",
+		"At most $PARALLEL commands run at a time unless specified",
+		"Each command runs on its own, Goto and Gosub can't be used within the block",
+		"  Parallel",
+		"  GetSystemViews",
+		"  GetSoftwareIdentities",
+		"  GetControllerViews",
+		"  EndParallel",
+		"  Parallel 2",
+		"  ...",
+		"  EndParallel"
+	],
+
 	"Print": [
 		"Print text substituting variables",
 		"  Print Hello World",
@@ -350,7 +697,7 @@ INTERNAL = {
 		"  <<Field1,Field2,Field3",
 		"  Report Field1,Field2 where Field3=String",
 		"  <<Field1,Field2 //Field3=String",
-		"Report is sorted by order of fields specified"
+		"Report is sorted by order of fields specified",
 		"  Report Field1,*",
 		"  <<Field1,*",
 		"  Report Field1,* where Field2=String",
@@ -359,7 +706,20 @@ INTERNAL = {
 		"  Report *",
 		"  <<*",
 		"  Report * where Field2=String",
-		"  <<* //Field2=String"
+		"  <<* //Field2=String",
+		"Where clauses can use =, !=, <, >, <=, >= and ~regex, numbers compare as numbers",
+		"Fields in where clauses with = are not shown",
+		"  Report Field1,Field2 where Field2>10 and Field3~^Str",
+		"  <<Field1,Field2 //Field2>10 //Field3~^Str",
+		"Sort by chosen fields, - for descending, and limit the number of rows",
+		"  Report Field1,Field2 sort -Field2,Field1 limit 10",
+		"Group by a field with count, min, max and sum of other fields, min and max of text compare it as text",
+		"  Report Field1,count,min(Field2),max(Field2),sum(Field2) group by Field1",
+		"Fields with more than one value per instance show them comma separated",
+		"Write to a file as csv, tsv, json or jsonl by its extension, csv otherwise",
+		"  Report Field1,Field2 where Field3=String > report.csv",
+		"  <<Field1,Field2 //Field3=String > report.csv",
+		"Set $FORMAT to csv, tsv, json or jsonl for a report in that format"
 	],
 
 	"Return": [
@@ -497,6 +857,7 @@ BIOS_METHODS = {
 
 	"GetBIOSEnumerations": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_BIOSEnumeration"
 	},
 
@@ -513,6 +874,7 @@ BIOS_METHODS = {
 
 	"GetBIOSIntegers": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_BIOSInteger"
 	},
 
@@ -529,6 +891,7 @@ BIOS_METHODS = {
 
 	"GetBIOSStrings": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_BIOSString"
 	},
 
@@ -740,6 +1103,7 @@ FC_METHODS = {
 
 	"GetFCAttributes": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_FCAttribute"
 	},
 
@@ -919,6 +1283,7 @@ NIC_METHODS = {
 
 	"GetNICAttributes": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_NICAttribute"
 	},
 
@@ -935,6 +1300,7 @@ NIC_METHODS = {
 
 	"GetNICEnumerations": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_NICEnumeration"
 	},
 
@@ -967,6 +1333,7 @@ NIC_METHODS = {
 
 	"GetNICIntegers": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_NICInteger"
 	},
 
@@ -999,6 +1366,7 @@ NIC_METHODS = {
 
 	"GetNICStrings": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_NICString"
 	},
 
@@ -1546,6 +1914,7 @@ RAID_METHODS = {
 
 	"GetRAIDEnumerations": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_RAIDEnumeration"
 	},
 
@@ -1562,6 +1931,7 @@ RAID_METHODS = {
 
 	"GetRAIDIntegers": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_RAIDInteger"
 	},
 
@@ -1602,6 +1972,7 @@ RAID_METHODS = {
 
 	"GetRAIDStrings": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_RAIDString"
 	},
 
@@ -1957,6 +2328,7 @@ iDRAC_METHODS = {
 
 	"GetiDRACCardAttributes": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_iDRACCardAttribute"
 	},
 	
@@ -1973,6 +2345,7 @@ iDRAC_METHODS = {
 
 	"GetiDRACCardEnumerations": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_iDRACCardEnumeration"
 	},
 
@@ -1989,6 +2362,7 @@ iDRAC_METHODS = {
 
 	"GetiDRACCardIntegers": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_iDRACCardInteger"
 	},
 
@@ -2005,6 +2379,7 @@ iDRAC_METHODS = {
 
 	"GetiDRACCardStrings": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_iDRACCardString"
 	},
 
@@ -2836,6 +3211,7 @@ LC_METHODS = {
 
 	"GetLCEnumerations": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_LCEnumeration"
 	},
 
@@ -2852,6 +3228,7 @@ LC_METHODS = {
 
 	"GetLCIntegers": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_LCInteger"
 	},
 
@@ -2868,6 +3245,7 @@ LC_METHODS = {
 
 	"GetLCStrings": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_LCString"
 	},
 
@@ -3404,6 +3782,7 @@ UPDATE_METHODS = {
 
 	"GetSoftwareIdentities": {
 		COMMAND: "enumerate",
+		ELEMENTS: 50,
 		URL: "cimv2/root/dcim/DCIM_SoftwareIdentity"
 	},
 
@@ -3763,11 +4142,13 @@ SYSTEM_METHODS = {
 	},
 	"GetSystemAttributes": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_SystemAttribute"
 	},
 
 	"GetSystemEnumerations": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_SystemEnumeration"
 	},
 
@@ -3784,6 +4165,7 @@ SYSTEM_METHODS = {
 
 	"GetSystemIntegers": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_SystemInteger"
 	},
 
@@ -3800,6 +4182,7 @@ SYSTEM_METHODS = {
 
 	"GetSystemStrings": {
 		COMMAND: "enumerate",
+		ELEMENTS: 100,
 		URL: "cimv2/root/dcim/DCIM_SystemString"
 	},
 
@@ -4841,6 +5224,7 @@ RECORD_LOG_METHODS = {
 
 	"GetLCLogEntries": {
 		COMMAND: "enumerate",
+		ELEMENTS: 50,
 		URL: "cimv2/root/dcim/DCIM_LCLogEntry"
 	},
 
@@ -4856,6 +5240,7 @@ RECORD_LOG_METHODS = {
 
 	"GetSystemEventLogEntries": {
 		COMMAND: "enumerate",
+		ELEMENTS: 50,
 		URL: "cimv2/root/dcim/DCIM_SELLogEntry"
 	}
 }
@@ -7733,6 +8118,72 @@ class Log(object):
 		self.file.flush()
 		self.stdout.write(data)
 
+# JSON lines trace of WS-MAN commands, one record per command
+#   Kept open, records are written every batch records or flush seconds
+class TraceWriter(object):
+	def __init__(self, name, payload=True, batch=TRACEBATCH, flush=TRACEFLUSH):
+		self.file = open(name, "a")
+		self.payload = payload
+		self.batch = batch
+		self.interval = flush
+		self.lock = threading.Lock()
+		self.pending = []
+		self.timer = None
+
+	def record(self, entry):
+		try:
+			line = json.dumps(entry, sort_keys=True)
+		except UnicodeDecodeError:
+			# Not UTF-8, keep the bytes as they are
+			line = json.dumps(entry, sort_keys=True, encoding="latin-1")
+
+		self.lock.acquire()
+		try:
+			if self.file == None:
+				return
+			self.pending.append(line + "\n")
+			if len(self.pending) >= self.batch:
+				self.write()
+			elif self.timer == None:
+				self.timer = threading.Timer(self.interval, self.flush)
+				self.timer.setDaemon(True)
+				self.timer.start()
+		finally:
+			self.lock.release()
+
+	# Caller holds the lock
+	def write(self):
+		if self.timer != None:
+			self.timer.cancel()
+			self.timer = None
+		if len(self.pending):
+			self.file.write("".join(self.pending))
+			self.file.flush()
+			self.pending = []
+
+	def flush(self):
+		self.lock.acquire()
+		try:
+			if self.file != None:
+				self.write()
+		finally:
+			self.lock.release()
+
+	def close(self):
+		self.lock.acquire()
+		try:
+			timer = self.timer
+			if self.file != None:
+				self.write()
+				self.file.close()
+				self.file = None
+		finally:
+			self.lock.release()
+
+		# Let it finish before the interpreter shuts down
+		if timer != None and timer != threading.currentThread():
+			timer.join()
+
 ###
 # XML interop
 
@@ -7814,6 +8265,253 @@ def toprettyxml(x):
 	text_re = re.compile('>\n\s+([^<>\s].*?)\n\s+</', re.DOTALL)
 	return re.sub("(?imu)^\s*\n", "", text_re.sub('>\g<1></', remove_xmltag(x.toprettyxml(indent=" "))))
 
+# Write XML to out as print toprettyxml() would, element by element as it is parsed
+def writeprettyxml(data, out):
+	for line in prettyjoin(prettylines(data)):
+		out.write(line + "\n")
+	out.write("\n")
+
+def prettyescape(data):
+	return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+# Lines of XML indented as the DOM toprettyxml(indent=" ") does
+def prettylines(data):
+	# Prefixes in scope for each open element
+	scopes = [[("xml", "http://www.w3.org/XML/1998/namespace")]]
+	declared = []
+
+	def qname(name, attribute=False):
+		if name[:1] != "{":
+			return name
+		uri, name = name[1:].split("}", 1)
+		for scope in scopes[::-1]:
+			for prefix, value in scope:
+				if value == uri and (prefix or not attribute):
+					return prefix and prefix + ":" + name or name
+		return name
+
+	# Open elements as [element, indent, start tag if no child yet, last child]
+	stack = []
+	for event, element in ElementTree.iterparse(StringIO.StringIO(data), ("start", "end", "start-ns")):
+		if event == "start-ns":
+			declared.append(element)
+			continue
+
+		if event == "start":
+			indent = ""
+			if len(stack):
+				parent = stack[-1]
+				indent = parent[1] + " "
+				if parent[2] != None:
+					yield parent[2] + ">"
+					parent[2] = None
+					if parent[0].text:
+						yield prettyescape(indent + parent[0].text)
+				elif parent[3].tail:
+					yield prettyescape(indent + parent[3].tail)
+
+				# Children written are let go
+				del parent[0][:-1]
+
+			scopes.append(declared)
+			attributes = [(prefix and "xmlns:" + prefix or "xmlns", uri) for prefix, uri in declared]
+			attributes.extend([(qname(name, True), value) for name, value in element.items()])
+			attributes.sort()
+			declared = []
+
+			tag = indent + "<" + qname(element.tag) + "".join([' %s="%s"' % (name, prettyescape(value)) for name, value in attributes])
+			stack.append([element, indent, tag, None])
+			continue
+
+		# Only text is on the line of its element
+		opened, indent, tag, last = stack.pop()
+		name = qname(element.tag)
+		if tag != None:
+			if element.text:
+				yield tag + ">" + prettyescape(element.text) + "</" + name + ">"
+			else:
+				yield tag + "/>"
+		else:
+			if last.tail:
+				yield prettyescape(indent + " " + last.tail)
+			yield indent + "</" + name + ">"
+
+		scopes.pop()
+		if len(stack):
+			stack[-1][3] = element
+
+# Lines of pretty XML with text after an element joined to it and its end tag,
+# and blank lines dropped, as the regular expressions of toprettyxml() do
+def prettyjoin(chunks):
+	held = None
+	joined = None
+	space = False
+	for chunk in chunks:
+		for line in chunk.split("\n"):
+			if line.strip() == "":
+				space = True
+				continue
+
+			text = line.lstrip()
+			space = space or text != line
+			if joined != None:
+				# Up to the first end tag after a line break and space
+				if space and text[:2] == "</":
+					held = "\n".join(joined[2:]) + text
+					joined = None
+				else:
+					joined.append(line)
+			elif held != None and held[-1:] == ">" and space and not text[:1] in "<>":
+				joined = [held, line, held + text]
+				held = None
+			else:
+				if held != None:
+					yield held
+				held = line
+			space = False
+
+	# Text without an end tag after it is left as is
+	if joined != None:
+		yield joined[0]
+		for line in prettyjoin(joined[1:2] + joined[3:]):
+			yield line
+	elif held != None:
+		yield held
+
+###
+# Result model
+#   Each element with child elements is a Record, each element with only text a
+#   (name, value) tuple in its fields. Selectors are (Name attribute, value, "Selector").
+
+class Record(object):
+	__slots__ = ("name", "fields")
+
+	def __init__(self, name, fields):
+		self.name = name
+		self.fields = fields
+
+# Top level record of a response, indexed by property name
+#   index maps each property name, and "Selector" for selectors, to the
+#   (record, value) pairs with it in document order. order maps each element
+#   name to when it was first seen.
+class Document(Record):
+	__slots__ = ("index", "order")
+
+	def __init__(self, name, fields):
+		Record.__init__(self, name, fields)
+		self.index = {}
+		self.order = {}
+
+	def add(self, record, field):
+		if type(field) is tuple:
+			name = field[0]
+			self.index.setdefault(name, []).append((record, field[1]))
+			if len(field) == 3:
+				name = field[2]
+				self.index.setdefault(name, []).append((record, field[1]))
+		else:
+			name = field.name
+
+		if not name in self.order:
+			self.order[name] = len(self.order)
+
+	# Element names in the order first seen
+	def names(self):
+		return sorted(self.order.keys(), key=self.order.get)
+
+	# Records and index of a page added after the pages before it
+	def extend(self, document):
+		self.fields[0].fields.extend(document.fields)
+		for name, pairs in document.index.items():
+			self.index.setdefault(name, []).extend(pairs)
+		for name in document.names():
+			if not name in self.order:
+				self.order[name] = len(self.order)
+
+# Property names are shared by all records
+NAMES = {}
+
+def localname(tag):
+	name = tag[tag.find("}") + 1:]
+	return NAMES.setdefault(name, name)
+
+# Parse a response page into records, returns the document record
+#   Only elements with a prefix are indexed by name, as the DOM matched prefixed names
+def parserecords(data):
+	stack = [[]]
+
+	# Default namespace and those with a prefix for each open element, elements in
+	# the default one have no prefix unless it has one as well
+	scopes = [(None, frozenset())]
+	declared = []
+	plain = set()
+	for event, element in ElementTree.iterparse(StringIO.StringIO(data), ("start", "end", "start-ns")):
+		if event == "start-ns":
+			declared.append(element)
+			continue
+
+		if event == "start":
+			stack.append([])
+			scope = scopes[-1]
+			if len(declared):
+				default = scope[0]
+				for prefix, uri in declared:
+					if prefix == "":
+						default = "{%s}" % uri
+				scope = (default, scope[1].union([uri for prefix, uri in declared if prefix != ""]))
+				declared = []
+			scopes.append(scope)
+			continue
+
+		fields = stack.pop()
+		name = localname(element.tag)
+		if len(fields):
+			field = Record(name, tuple(fields))
+		else:
+			if name == "Selector":
+				selector = element.get("Name", "")
+				field = (NAMES.setdefault(selector, selector), (element.text or "").strip(), name)
+			else:
+				field = (name, (element.text or "").strip())
+		stack[-1].append(field)
+
+		default, prefixed = scopes.pop()
+		if element.tag[:1] != "{" or (default != None and element.tag.startswith(default) and not default[1:-1] in prefixed):
+			plain.add(id(field))
+		element.clear()
+
+	document = Document(DOCUMENT, stack[0])
+	for record, field in walkrecords(document):
+		if not id(field) in plain:
+			document.add(record, field)
+
+	return document
+
+# Name of a record or property
+def fieldname(field):
+	if type(field) is tuple:
+		return field[0]
+	return field.name
+
+# Each record and property below record in document order, with its record
+def walkrecords(record):
+	for field in record.fields:
+		yield record, field
+		if type(field) is not tuple:
+			for pair in walkrecords(field):
+				yield pair
+
+# Top level records, those separated by a blank line in plain text
+def instances(record):
+	for field in record.fields:
+		name = fieldname(field)
+		if name in PLAINWRAPPERS:
+			if type(field) is not tuple:
+				for instance in instances(field):
+					yield instance
+		elif not name in PLAINSKIPPED:
+			yield field
+
 def getNodeText(nodelist):
 	rc = ""
 	for node in nodelist:
@@ -7838,10 +8536,20 @@ def makeparam(nvpairs):
 			print "Skipping '%s' not in name=value format" % nvpair
 	return params
 
+# Parsed commands are cached, Until loops build the same one over and over
+#   Callers must not change the params returned
 def parsecmd(command):
-	command = shlex.split(command.strip())
-	method = command.pop(0)
-	params = makeparam(command)
+	if command in PARSED:
+		return PARSED[command]
+
+	acommand = shlex.split(command.strip())
+	method = acommand.pop(0)
+	params = makeparam(acommand)
+
+	if len(PARSED) >= PARSEDMAX:
+		PARSED.clear()
+	PARSED[command] = (method, params)
+
 	return method, params
 
 def getfilemode(mdata):
@@ -7859,15 +8567,68 @@ def getfilemode(mdata):
 
 	return filemode
 
-def buildparams(mdata, paramtype, method, params, eprselect, filemode, fnumber):
-	cmd = ""
+# Method catalog entry with everything that doesn't change between calls worked out
+class Template(object):
+	__slots__ = ["method", "mdata", "api", "command", "prefix", "flags", "filemode", "params", "url"]
+
+	def __init__(self, method, mdata):
+		self.method = method
+		self.mdata = mdata
+		self.command = mdata[COMMAND]
+
+		if NAME in mdata:
+			self.api = mdata[NAME]
+		else:
+			self.api = method
+
+		if "win" in sys.platform:
+			self.prefix = "winrm"
+		else:
+			self.prefix = "wsman"
+		self.prefix += " %s" % self.command
+		if self.command == "invoke":
+			if not "win" in sys.platform:
+				self.prefix += " -a"
+			self.prefix += " %s" % self.api
+
+		if "win" in sys.platform:
+			self.flags = " -SkipCNcheck -SkipCAcheck -SkipRevocationCheck -encoding:utf-8 -a:basic -format:pretty"
+		else:
+			self.flags = " -V -v -c dummy.cert -j utf-8 -y basic"
+
+		self.filemode = getfilemode(mdata)
+
+		# Sorted (name, default) per parameter type
+		self.params = {}
+		for paramtype in [GETPARAMS, PARAMS]:
+			if paramtype in mdata:
+				mparams = mdata[paramtype].keys()
+				mparams.sort()
+				self.params[paramtype] = [(param, mdata[paramtype][param][DEFAULT]) for param in mparams]
 
-	mparams = mdata[paramtype].keys()
-	mparams.sort()
+		self.url = mdata.get(URL)
 
-	for param in mparams:
-		if not param in params.keys():
-			default = mdata[paramtype][param][DEFAULT]
+# Compiled template for a method on the current $DEVICE, None if there is no such method
+def gettemplate(method):
+	key = (VARIABLES[DEVICE], method)
+	if key in TEMPLATES:
+		return TEMPLATES[key]
+
+	if VARIABLES[DEVICE] == "idrac" and method in METHODS:
+		mdata = METHODS[method]
+	elif VARIABLES[DEVICE] == "cmc" and method in CMC_METHODS:
+		mdata = CMC_METHODS[method]
+	else:
+		return None
+
+	TEMPLATES[key] = Template(method, mdata)
+	return TEMPLATES[key]
+
+def buildparams(template, paramtype, method, params, eprselect, filemode, body, pairs=None):
+	cmd = ""
+
+	for param, default in template.params[paramtype]:
+		if not param in params:
 			if default == None:
 				if VAR_LINE in VARIABLES: print "%d: " % VARIABLES[VAR_LINE],
 				print "Required parameter '%s' missing for method '%s'" % (param, method)
@@ -7902,7 +8663,7 @@ def buildparams(mdata, paramtype, method, params, eprselect, filemode, fnumber):
 			else:
 				if filemode == True:
 					if param == "TargetRef":
-						os.write(fnumber, getaddressxml("Target", "http://schemas.dell.com/wbem/wscim/1/cim-schema/2/DCIM_SoftwareIdentity", {"InstanceID": val}))
+						body.append(getaddressxml("Target", "http://schemas.dell.com/wbem/wscim/1/cim-schema/2/DCIM_SoftwareIdentity", {"InstanceID": val}))
 					elif type(val) == types.StringType and "EPR:" in val:
 						address = get_cached_epr(val, param, eprselect)
 						if address == None:
@@ -7912,10 +8673,13 @@ def buildparams(mdata, paramtype, method, params, eprselect, filemode, fnumber):
 
 							set_cached_epr(val, param, eprselect, address)
 
-						os.write(fnumber, address)
+						body.append(address)
 					else:
-						os.write(fnumber, "  <p:%s>%s</p:%s>\r\n" % (param, val, param))
+						body.append("  <p:%s>%s</p:%s>\r\n" % (param, val, param))
 				else:
+					if pairs != None:
+						pairs.append((param, val))
+
 					if "win" in sys.platform:
 						cmd += "%s=\"%s\";" % (param, val)
 					else:
@@ -7929,103 +8693,116 @@ def buildparams(mdata, paramtype, method, params, eprselect, filemode, fnumber):
 
 	return cmd
 
+# wsman/winrm command line, method name and request details for the native transport
+#   With winrm the input is in a temporary file, callers remove it with removeinput()
 def buildcmd(command):
-	global TEMPFILES
 	global VARIABLES
 	global VAR_LINE
 
 	method, params = parsecmd(command)
 
-	if method in METHODS.keys() and VARIABLES[DEVICE]=="idrac":
-		mdata = METHODS[method]
-		#print mdata
-	elif method in CMC_METHODS.keys() and VARIABLES[DEVICE]=="cmc":
-		mdata = CMC_METHODS[method]
-	else:
+	template = gettemplate(method)
+	if template == None:
 		if VAR_LINE in VARIABLES: print "%d: " % VARIABLES[VAR_LINE],
 		print "Invalid method '%s'" % method.replace("\\\\", "\\")
-		return None, None
+		return None, None, None
+
+	mdata = template.mdata
+	api = template.api
+	cmd = template.prefix
+
+	# Request details for the native transport
+	wsreq = {
+		"command": template.command,
+		"action": api,
+		"url": "",
+		"params": [],
+		"dialect": None,
+		"filter": None,
+		"epr": False,
+		"maxelements": 0,
+		"timeout": 0,
+		"retries": 0,
+		"input": "",
+		"inputfile": None,
+		"phases": {},
+		"retried": 0,
+		"deadline": None,
+		"failed": False
+	}
 
-	if NAME in mdata:
-		api = mdata[NAME]
-	else:
-		api = method
+	eprselect = {}
+	if "-eprselect" in params:
+		eprselect = parse_eprselect(params["-eprselect"][0])
 
-	if "win" in sys.platform:
-		cmd = "winrm"
-	else:
-		cmd = "wsman"
+	filemode = template.filemode
 
-	cmd += " %s" % mdata[COMMAND]
-	if mdata[COMMAND] == "invoke":
-		if not "win" in sys.platform:
-			cmd += " -a"
-		cmd += " %s" % api
-	
-	eprselect = {}
-	for param in params:
-		if param == "-eprselect":
-			try:
-				eprselect = params[param][0]
-				
-			except:
-				print "Invalid syntax for -eprselect=Name=Value,Param:Name=Value,..."
-				return None
-			
-			eprselect = parse_eprselect(eprselect)
+	if template.command == "enumerate":
+		maxelements = getmaxelements(mdata, params)
+		if maxelements == None:
+			return None, None, None
+		wsreq["maxelements"] = maxelements
 
-			break
-	
-	filemode = getfilemode(mdata)
+		# Not available with winrm
+		if maxelements and not "win" in sys.platform:
+			cmd += " --optimize --max-elements=%d" % maxelements
 
-	if URL in mdata:
-		url = mdata[URL]
+	timeout, retries = getretries(params)
+	if timeout == None:
+		return None, None, None
+	wsreq["timeout"] = timeout
+	wsreq["retries"] = retries
 
-		if "EPR" in mdata[URL]:
+	if template.url != None:
+		url = template.url
+
+		if "EPR" in template.url:
 			
-			url = get_cached_epr(mdata[URL], URL, eprselect)
+			url = get_cached_epr(template.url, URL, eprselect)
 			if url == None:
-				url = buildurl(method, mdata[URL], eprselect)
+				url = buildurl(method, template.url, eprselect)
 				if url == None:
-					return None, None
+					return None, None, None
 
-				set_cached_epr(mdata[URL], URL, eprselect, url)
+				set_cached_epr(template.url, URL, eprselect, url)
 
 		if filemode == True:
-			(fnumber, fname) = tempfile.mkstemp()
 			if "http://" in url:
-				os.write(fnumber, "<p:%s_INPUT xmlns:p=\"%s\">\r\n" % (api, url.split("?")[0]))
+				body = ["<p:%s_INPUT xmlns:p=\"%s\">\r\n" % (api, url.split("?")[0])]
 			else:
-				os.write(fnumber, "<p:%s_INPUT xmlns:p=\"http://schemas.dmtf.org/wbem/wscim/1/cim-schema/%s\">\r\n" % (api, url.split("?")[0][4:]))
+				body = ["<p:%s_INPUT xmlns:p=\"http://schemas.dmtf.org/wbem/wscim/1/cim-schema/%s\">\r\n" % (api, url.split("?")[0][4:])]
 		else:
-			fnumber = None
+			body = None
 
 		if "win" in sys.platform:
 			cmd += ' "%s' % url
 		else:
 			cmd += ' "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/%s' % url[4:].replace("+", ",")
+		wsreq["url"] = url
 
-		if GETPARAMS in mdata:
+		if GETPARAMS in template.params:
 			if not method in METAMETHODS:
 				cmd += "?"
+				wsreq["url"] += "?"
 
-			pars = buildparams(mdata, GETPARAMS, method, params, eprselect, filemode, fnumber)
+			pars = buildparams(template, GETPARAMS, method, params, eprselect, filemode, body)
 			if pars == None:
-				return None, None
+				return None, None, None
 			cmd += pars
+			wsreq["url"] += pars
 		cmd += '"'
 
-	if PARAMS in mdata.keys():
+	if PARAMS in template.params:
 		if not filemode and "win" in sys.platform:
 			cmd += " @{"
-		pars = buildparams(mdata, PARAMS, method, params, eprselect, filemode, fnumber)
+		pars = buildparams(template, PARAMS, method, params, eprselect, filemode, body, wsreq["params"])
 		if pars == None:
-			return None, None
+			return None, None, None
 		cmd += pars
 
 	ip = getip()
 	if ip == None:
-		return None, None
+		return None, None, None
 
 	port = PORTDEFAULT
 	if PORT in VARIABLES.keys():
@@ -8036,6 +8813,8 @@ def buildcmd(command):
 	else:
 		cmd += " -h %s" % ip
 		cmd += " -P %s" % port
+	wsreq["ip"] = ip
+	wsreq["port"] = port
 
 	if LOGIN in VARIABLES.keys():
 		cmd += " -u"
@@ -8044,9 +8823,10 @@ def buildcmd(command):
 		else:
 			cmd += " "
 		cmd += "%s" % VARIABLES[LOGIN]
+		wsreq["login"] = VARIABLES[LOGIN]
 	else:
 		print "Login ID undefined. --> Set $LOGIN username"
-		return None, None
+		return None, None, None
 
 	if PASS in VARIABLES.keys():
 		cmd += " -p"
@@ -8055,20 +8835,18 @@ def buildcmd(command):
 		else:
 			cmd += " "
 		cmd += "%s" % VARIABLES[PASS]
+		wsreq["password"] = VARIABLES[PASS]
 	else:
 		print "Password undefined. --> Set $PASSWORD password"
-		return None, None
+		return None, None, None
 
-	if "win" in sys.platform:
-		cmd += " -SkipCNcheck -SkipCAcheck -SkipRevocationCheck -encoding:utf-8 -a:basic -format:pretty"
-	else:
-		cmd += " -V -v -c dummy.cert -j utf-8 -y basic"
+	cmd += template.flags
 
-	if "-cql" in params.keys() or "-wql" in params.keys() or "-assoc" in params.keys():
-		if "-wql" in params.keys():
+	if "-cql" in params or "-wql" in params or "-assoc" in params:
+		if "-wql" in params:
 			filt = "-wql"
 			dialect = "http://schemas.microsoft.com/wbem/wsman/1/WQL"
-		elif "-assoc" in params.keys():
+		elif "-assoc" in params:
 			filt = "-assoc"
 			dialect = "http://schemas.dmtf.org/wbem/wsman/1/cimbinding/associationFilter"
 		else:
@@ -8079,32 +8857,82 @@ def buildcmd(command):
 			cmd += " -dialect:%s -filter:\"%s\"" % (dialect, params[filt][0])
 		else:
 			cmd += " --dialect=%s --filter=\"%s\"" % (dialect, params[filt][0])
+		wsreq["dialect"] = dialect
+		wsreq["filter"] = params[filt][0]
 
 	if method == "GetEPR":
 		if "win" in sys.platform:
 			cmd += " -returntype:EPR"
 		else:
 			cmd += " -M epr"
+		wsreq["epr"] = True
 
 	if filemode:
-		os.write(fnumber, "</p:%s_INPUT>\r\n" % api)
-		os.close(fnumber)
+		body.append("</p:%s_INPUT>\r\n" % api)
+		wsreq["input"] = "".join(body)
 
 		if "win" in sys.platform:
-			cmd += " -file:"
+			# winrm only reads input from a file, deleted once the method has run
+			(fnumber, fname) = tempfile.mkstemp()
+			os.write(fnumber, wsreq["input"])
+			os.close(fnumber)
+			cmd += " -file:%s" % fname
+			wsreq["inputfile"] = fname
 		else:
-			cmd += " -J "
-		cmd += "%s" % fname
+			# Input piped in by wsmanpages()
+			cmd += " -J /dev/stdin"
+
+	return cmd, method, wsreq
+
+def removeinput(wsreq):
+	if wsreq != None and wsreq["inputfile"] != None:
+		os.unlink(wsreq["inputfile"])
+		wsreq["inputfile"] = None
+
+# Items per enumeration response - -maxelements, $MAXELEMENTS or method default
+#   0 for an unoptimized enumeration
+def getmaxelements(mdata, params):
+	maxelements = 0
+	try:
+		if "-maxelements" in params:
+			maxelements = int(params["-maxelements"][0])
+		elif int(VARIABLES[MAXELEMENTS]):
+			maxelements = int(VARIABLES[MAXELEMENTS])
+		elif ELEMENTS in mdata:
+			maxelements = mdata[ELEMENTS]
+
+		if maxelements < 0:
+			raise ValueError
+	except:
+		print "Invalid syntax for -maxelements=N"
+		return None
+
+	return maxelements
+
+# Seconds before giving up and number of retries - -timeout/-retries or $TIMEOUT/$RETRIES
+def getretries(params):
+	values = []
+	for option, var in [("-timeout", TIMEOUT), ("-retries", RETRIES)]:
+		try:
+			if option in params:
+				value = int(params[option][0])
+			else:
+				value = int(VARIABLES[var])
 
-		TEMPFILES.append(fname)
+			if value < 0:
+				raise ValueError
+		except:
+			print "Invalid syntax for %s=N" % option
+			return None, None
+		values.append(value)
 
-	return cmd, method
+	return values[0], values[1]
 
 ###
 # Address generation using EPR
 
 def getepr(method, _class):
-	global OUTPUTXMLOBJ
+	global OUTPUTTREE
 
 	_class = _class.split(":")
 	if len(_class) != 2:
@@ -8113,11 +8941,11 @@ def getepr(method, _class):
 
 	_class = _class[1]
 	run("GetEPR Class=%s" % _class)
-	if OUTPUTXMLOBJ == None:
+	if OUTPUTTREE == None:
 		print "GetEPR failed for class '%s'" % _class
 		return None
 
-	return OUTPUTXMLOBJ
+	return OUTPUTTREE
 
 def getselectors(x, param, eprselect):
 	fname = ""
@@ -8136,14 +8964,16 @@ def getselectors(x, param, eprselect):
 
 	found = False
 	instance = 0
-	ns = "http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd"
-	xselectorsets = x.getElementsByTagNameNS(ns, "SelectorSet")
+	xselectorsets = []
+	for record, value in x.index.get("Selector", []):
+		if not len(xselectorsets) or xselectorsets[-1] is not record:
+			xselectorsets.append(record)
+
 	for xselectorset in xselectorsets:
 		selectors = {}
-		xselectors = xselectorset.getElementsByTagNameNS(ns, "Selector")
-		for selector in xselectors:
-			name = selector.getAttribute("Name").encode("ascii")
-			value = selector.firstChild.data.encode("ascii")
+		for selector in xselectorset.fields:
+			name = selector[0].encode("ascii")
+			value = selector[1].encode("ascii")
 			if name:
 				selectors[name] = value
 
@@ -8174,13 +9004,12 @@ def getaddressobj(method, _class, param, eprselect):
 	if selectors == None:
 		return None, None
 
-	ns = "http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd"
-	rURI = x.getElementsByTagNameNS(ns, "ResourceURI")
+	rURI = x.index.get("ResourceURI", [])
 	if len(rURI) < instance+1:
 		print "EPR:x:Class declaration for method '%s' where x > instances" % method
 		return None, None
 
-	url = rURI[instance].firstChild.data.encode("ascii")
+	url = rURI[instance][1].encode("ascii")
 
 	return url, selectors
 
@@ -8311,6 +9140,7 @@ def context(cmd):
 
 def count(cmd):
 	global OUTPUT
+	global OUTPUTTREE
 	global VARIABLES
 
 	cmd = shlex.split(cmd)
@@ -8319,7 +9149,10 @@ def count(cmd):
 		print "\nRequire 1 argument"
 		return None
 
-	VARIABLES[cmd[1]] = OUTPUT.count("\n\n")
+	if OUTPUTTREE != None:
+		VARIABLES[cmd[1]] = len(list(instances(OUTPUTTREE)))
+	else:
+		VARIABLES[cmd[1]] = get_output().count("\n\n")
 
 	return True
 
@@ -8397,7 +9230,7 @@ def find(cmd, context=False):
 
 def findall(cmd, inst=None):
 	global CONTEXT
-	global OUTPUTXMLOBJ
+	global OUTPUTTREE
 	global VARIABLES
 	global VAR_FIND
 	global VAR_PARENT
@@ -8419,23 +9252,27 @@ def findall(cmd, inst=None):
 	if CONTEXT != None:
 		x = CONTEXT
 	else:
-		x = OUTPUTXMLOBJ
+		x = OUTPUTTREE
+
+	# Whole response is looked up in its index
+	if isinstance(x, Document):
+		for record, value in x.index.get(look, [])[:inst]:
+			results.append(value.encode("ascii"))
+			parents.append(record)
+		x = None
 
-	def recurse_findall(node, key):
-		if node == None:
+	def recurse_findall(record, key):
+		if record == None:
 			return
 
-		if node.nodeName != "":
-			name = node.nodeName.split(":")
-			if len(name) == 2 and ((name[1] == key) or (name[1] == "Selector" and node.getAttribute("Name") == key)):
-					text = getNodeText(node.childNodes)
-					if text != None:
-						results.append(text.encode("ascii"))
-						parents.append(node.parentNode)
-						return
+		for field in record.fields:
+			if type(field) is tuple:
+				if field[0] == key or (len(field) == 3 and field[2] == key):
+					results.append(field[1].encode("ascii"))
+					parents.append(record)
+			else:
+				recurse_findall(field, key)
 
-		for child in node.childNodes:
-			recurse_findall(child, key)
 			if inst != None and len(results) == inst:
 				return
 
@@ -8573,6 +9410,8 @@ def help(command):
 								print "  %s=%s %s" % (param, val, req)
 						else:
 							print "  %s=%s %s" % (param, METHODS[command[1]][ptypes][param][key], req)
+			if ELEMENTS in METHODS[command[1]]:
+				print "  -maxelements=%d" % METHODS[command[1]][ELEMENTS]
 			print
 		elif len(command) == 2 and get_camel(command[1].lower()) in INTERNAL.keys():
 			if VARIABLES[PROGRAM] == True:
@@ -8631,6 +9470,112 @@ def log(cmd):
 
 	return True
 
+# Run the commands up to EndParallel concurrently, each in a copy of the current state
+#   Output, variables and return codes are merged in line order once all complete
+def parallel(cmd):
+	global CONTEXT
+	global GOTO
+	global INPUT
+	global INPUTXML
+	global OUTPUT
+	global OUTPUTXML
+	global OUTPUTXMLOBJ
+	global OUTPUTTREE
+	global VARIABLES
+
+	if not len(BATCH):
+		print "\nNot in batch mode"
+		return None
+
+	cmd = shlex.split(cmd)
+	if len(cmd) > 2:
+		help("help parallel")
+		print "\nRequire 0 or 1 argument"
+		return None
+
+	try:
+		limit = int(VARIABLES[PARALLEL])
+		if limit < 1:
+			raise ValueError
+	except:
+		print "\nNumeric value expected for $PARALLEL"
+		return None
+
+	if len(cmd) == 2:
+		try:
+			limit = int(replvars(cmd[1]))
+			if limit < 1:
+				raise ValueError
+		except:
+			help("help parallel")
+			print "\nArgument 1 value not a positive integer: %s" % replvars(cmd[1])
+			return None
+
+	lines = BATCH[-1]
+	end = VARIABLES[VAR_LINE] + 1
+	while end < len(lines) and lines[end].strip().lower() != "endparallel":
+		end += 1
+	if end == len(lines):
+		print "\nParallel without EndParallel"
+		return None
+
+	snapshot = copy.deepcopy(VARIABLES)
+	sessions = []
+	for i in range(VARIABLES[VAR_LINE] + 1, end):
+		line = lines[i].strip()
+		if line == "" or line[0] in ["#", ":"]:
+			continue
+
+		session = Session(stdout=StringIO.StringIO())
+		session.state["CONTEXT"] = CONTEXT
+		session.state["INPUT"] = None
+		session.state["OUTPUT"] = OUTPUT
+		session.state["OUTPUTXML"] = OUTPUTXML
+		session.state["OUTPUTXMLOBJ"] = OUTPUTXMLOBJ
+		session.state["OUTPUTTREE"] = OUTPUTTREE
+		session.state["VARIABLES"][VAR_LINE] = i
+		sessions.append((session, line.replace("\\", "\\\\")))
+
+	def task(session, line):
+		session.ret = session.run(line)
+
+	runpool([lambda s=s, l=l: task(s, l) for s, l in sessions], limit)
+
+	ret = True
+	for session, line in sessions:
+		sys.stdout.write(session.stdout.getvalue())
+
+		# Changes by each command applied in line order, so later lines win
+		variables = session.state["VARIABLES"]
+		for name in variables.keys():
+			if name in [VAR_BATCHFILE, VAR_LINE]:
+				continue
+			if not name in snapshot or variables[name] != snapshot[name]:
+				VARIABLES[name] = variables[name]
+		for name in snapshot.keys():
+			if not name in variables and name in VARIABLES:
+				del VARIABLES[name]
+
+		if ret == True and session.ret != True:
+			ret = session.ret
+
+	# Output of the last method run is current, same as running them one after another
+	for session, line in sessions:
+		state = session.state
+		if state["INPUT"] != None:
+			CONTEXT = state["CONTEXT"]
+			INPUT = state["INPUT"]
+			INPUTXML = state["INPUTXML"]
+			OUTPUT = state["OUTPUT"]
+			OUTPUTXML = state["OUTPUTXML"]
+			OUTPUTXMLOBJ = state["OUTPUTXMLOBJ"]
+			OUTPUTTREE = state["OUTPUTTREE"]
+
+	# Continue after EndParallel
+	GOTO = end + 1
+
+	return ret
+
 def printcmd(cmd):
 	cmd = cmd.split(" ", 1)
 
@@ -8645,32 +9590,164 @@ def printcmd(cmd):
 
 	return True
 
+# Number in a report value, None if not one
+def reportnumber(value):
+	try:
+		return int(value)
+	except:
+		try:
+			return float(value)
+		except:
+			return None
+
+# Clauses after the fields of a report, None if invalid
+#   where Field=Value [and Field>Value ...] sort Field,-Field limit N group by Field
+def reportclauses(args):
+	predicates = []
+	sort = []
+	limit = None
+	group = None
+
+	i = 0
+	while i < len(args):
+		word = args[i].lower()
+		if word in ["where", "and"] and i + 1 < len(args):
+			match = re.match("(.+?)(!=|<=|>=|=|<|>|~)(.*)$", args[i+1])
+			if match == None:
+				return None
+			if match.group(2) == "~":
+				try:
+					re.compile(match.group(3))
+				except re.error:
+					return None
+			predicates.append(match.groups())
+			i += 2
+		elif word == "sort" and i + 1 < len(args):
+			sort = args[i+1].split(",")
+			i += 2
+		elif word == "limit" and i + 1 < len(args):
+			limit = reportnumber(args[i+1])
+			if type(limit) != types.IntType or limit < 0:
+				return None
+			i += 2
+		elif word == "group" and i + 2 < len(args) and args[i+1].lower() == "by":
+			group = args[i+2]
+			i += 3
+		else:
+			return None
+
+	return predicates, sort, limit, group
+
+# Test for a where clause, numbers are compared as numbers
+def reporttest(op, operand):
+	if op == "~":
+		regex = re.compile(operand)
+		return lambda value: regex.search(value) != None
+
+	number = reportnumber(operand)
+	compare = {
+		"=": lambda a, b: a == b,
+		"!=": lambda a, b: a != b,
+		"<": lambda a, b: a < b,
+		">": lambda a, b: a > b,
+		"<=": lambda a, b: a <= b,
+		">=": lambda a, b: a >= b
+	}[op]
+
+	def test(value):
+		if number != None:
+			value = reportnumber(value)
+			if value == None:
+				return op == "!="
+			return compare(value, number)
+		return compare(value, operand)
+
+	return test
+
+# Sort key with numbers before text and in numeric order
+def reportkey(value):
+	number = reportnumber(value)
+	if number != None:
+		return (0, number, "")
+	return (1, 0, value)
+
+# Values of field for each instance in rows, multiple values are a tuple and
+# missing ones ""
+def reportcolumn(x, field, rows, rowof):
+	pairs = x.index.get(field, [])
+	if not len(pairs):
+		return None
+
+	column = [[] for row in rows]
+	outside = []
+	for record, value in pairs:
+		row = rowof.get(id(record))
+		if row == None:
+			outside.append(value)
+		else:
+			column[row].append(value)
+
+	# Fields outside the instances, from the header, line up if one each
+	if len(outside) == len(pairs):
+		if len(outside) != len(rows):
+			return None
+		return outside
+
+	for i in range(len(column)):
+		if len(column[i]) == 1:
+			column[i] = column[i][0]
+		elif len(column[i]):
+			column[i] = tuple(column[i])
+		else:
+			column[i] = ""
+	return column
+
+# Format of Report ... > file by its extension, csv otherwise
+REPORTFORMATS = {
+	".csv": CSV,
+	".tsv": TSV,
+	".json": JSON,
+	".jsonl": JSONL
+}
+
+# Text of a value in a report
+def reporttext(value):
+	if type(value) == types.TupleType:
+		return ",".join(value)
+	return value
+
 def report(cmd):
+	global OUTPUTTREE
 	global VARIABLES
 
 	cmd = shlex.split(cmd)
-	if len(cmd) != 2 and len(cmd) != 4:
+	if len(cmd) < 2:
 		help("help report")
-		print "\nRequire 1 or 3 arguments"
+		print "\nRequire 1 or more arguments"
 		return None
 
+	# Report ... > file writes the rows to file, formatted by its extension
+	filename = None
+	for i in range(2, len(cmd)):
+		if cmd[i][:1] == ">":
+			rest = [j for j in [cmd[i][1:]] + cmd[i+1:] if j != ""]
+			if len(rest) != 1:
+				help("help report")
+				print "\nInvalid syntax for report"
+				return None
+			filename = replvars(rest[0])
+			cmd = cmd[:i]
+			break
+
 	# Which fields to display
 	fields = replvars(cmd[1]).split(",")
 
-	key = ""
-	value = ""
-	if len(cmd) == 4:
-		if cmd[2].lower() != "where":
-			help("help report")
-			print "\nInvalid syntax for report"
-			return None
-
-		try:
-			key, value = replvars(cmd[3]).split("=", 1)
-		except:
-			help("help report")
-			print "\nInvalid syntax for report"
-			return None
+	clauses = reportclauses([replvars(i) for i in cmd[2:]])
+	if clauses == None:
+		help("help report")
+		print "\nInvalid syntax for report"
+		return None
+	predicates, sort, limit, group = clauses
 
 	# Expand *
 	if "*" in fields:
@@ -8689,92 +9766,184 @@ def report(cmd):
 		except:
 			pass
 
-	# Add key to data field
-	if key != "" and not key in fields:
-		fields.append(key)
-
-	# Count number of chunks in output
-	chunks = 0
-	if count("Count %s" % VAR_COUNT):
-		chunks = VARIABLES[VAR_COUNT]
-		del VARIABLES[VAR_COUNT]
-
-	# Find data for all fields requested
-	blank = []
-	multiple = []
-	data = {}
-	widths = {}
-	for field in fields:
-		if findall("Findall \"%s\" %s" % (field, VAR_FIND)):
-			data[field] = VARIABLES[VAR_FIND]
-			del VARIABLES[VAR_FIND]
-			del VARIABLES[VAR_PARENT]
-			if len(data[field]) != chunks:
-				print "Multi-value field '%s', skipping" % field
-				blank.append(field)
-				del data[field]
-		else:
-			blank.append(field)
+	# Aggregations when grouped, count or min, max and sum of a field
+	aggregates = {}
+	if group != None:
+		for field in fields:
+			match = re.match("(count)$|(min|max|sum)\((.+)\)$", field)
+			if match != None:
+				aggregates[field] = (match.group(1) or match.group(2), match.group(3))
+			elif field != group:
+				help("help report")
+				print "\nField '%s' is not the group or an aggregation" % field
+				return None
 
-	# Remove empty fields
-	for field in blank:
-		print "No data for field '%s', skipping" % field
-		fields.remove(field)
+	# Fields only used to filter, sort or group are not displayed, nor those
+	# in where clauses with = as their value is known
+	hidden = [i[0] for i in predicates] + [i.lstrip("-") for i in sort if not i.lstrip("-") in aggregates]
+	hidden += [i[1] for i in aggregates.values() if i[1] != None]
+	if group != None:
+		hidden.append(group)
+	shown = [i for i in fields if not i in aggregates]
+	fields = [i for i in fields if not i in [j[0] for j in predicates if j[1] == "="]]
+	needed = shown + [i for i in hidden if not i in shown]
+	needed = [needed[i] for i in range(len(needed)) if not needed[i] in needed[:i]]
+
+	# Each instance is a row, each field a column
+	x = OUTPUTTREE
+	rows = []
+	rowof = {}
+	if isinstance(x, Document):
+		rows = list(instances(x))
+		for row in range(len(rows)):
+			if type(rows[row]) is not tuple:
+				rowof[id(rows[row])] = row
+				for record, field in walkrecords(rows[row]):
+					if type(field) is not tuple:
+						rowof[id(field)] = row
+
+	columns = {}
+	for field in needed:
+		column = None
+		if len(rows):
+			column = reportcolumn(x, field, rows, rowof)
+		if column == None:
+			# Kept out of rows printed as csv, tsv, json or jsonl
+			if filename == None and VARIABLES[FORMAT] in [JSON, JSONL, CSV, TSV]:
+				sys.stderr.write("No data for field '%s', skipping\n" % field)
+			else:
+				print "No data for field '%s', skipping" % field
+			if field in fields:
+				fields.remove(field)
+		else:
+			columns[field] = column
 
 	# Return if all blank
-	if not len(fields) or (len(fields) == 1 and key in fields):
+	if not len(fields):
 		return
 
-	# Generator
-	def consol(dict):
-		for key in fields:
-			yield dict[key]
+	# Filter, a row is kept if it passes all where clauses
+	mask = [True] * len(rows)
+	for field, op, operand in predicates:
+		if not field in columns:
+			# Invalid key field, ignore
+			continue
 
-	# Filter if requested
-	if key != "":
-		if not key in fields:
-			# Invalid key field, remove
-			key = ""
-		else:
-			i = 0
-			while i < len(data[key]):
-				if data[key][i] != value:
-					for field in fields:
-						del data[field][i]
+		test = reporttest(op, operand)
+		column = columns[field]
+		for i in range(len(mask)):
+			if mask[i]:
+				value = column[i]
+				if type(value) == types.TupleType:
+					mask[i] = len([j for j in value if test(j)]) > 0
 				else:
-					i += 1
+					mask[i] = test(value)
+	selected = [i for i in range(len(mask)) if mask[i]]
+
+	# Group, one row for each value of the group field
+	if group != None:
+		if not group in columns:
+			return
+		groups = {}
+		for i in selected:
+			groups.setdefault(reporttext(columns[group][i]), []).append(i)
+
+		keys = sorted(groups.keys(), key=reportkey)
+		grouped = {}
+		for field in fields:
+			if field == group:
+				grouped[field] = keys
+				continue
+
+			function, source = aggregates[field]
+			values = []
+			for key in keys:
+				if function == "count":
+					values.append(str(len(groups[key])))
+					continue
+				if not source in columns:
+					values.append("")
+					continue
+				texts = [reporttext(columns[source][i]) for i in groups[key]]
+				numbers = [reportnumber(i) for i in texts]
+				numbers = [i for i in numbers if i != None]
+				if function == "sum":
+					if len(numbers):
+						values.append(str(sum(numbers)))
+					else:
+						values.append("")
+				elif len(numbers):
+					values.append(str({"min": min, "max": max}[function](numbers)))
+				else:
+					# Text is compared as text
+					texts = [i for i in texts if i != ""]
+					if len(texts):
+						values.append({"min": min, "max": max}[function](texts))
+					else:
+						values.append("")
+			grouped[field] = values
+		columns = grouped
+		selected = range(len(keys))
+		if len(sort):
+			sort = [i for i in sort if i.lstrip("-") in fields]
+	else:
+		# Sorted by all fields unless asked otherwise
+		needed = [i for i in needed if i in columns]
+		selected.sort(key=lambda i: [columns[field][i] for field in needed])
+
+	# Later keys first as sorting is stable
+	for field in sort[::-1]:
+		name = field.lstrip("-")
+		if name in columns:
+			selected.sort(key=lambda i: reportkey(reporttext(columns[name][i])), reverse=field[:1] == "-")
+
+	if limit != None:
+		selected = selected[:limit]
+
+	# Written row by row
+	fmt = VARIABLES[FORMAT]
+	if filename != None:
+		fmt = REPORTFORMATS.get(os.path.splitext(filename)[1].lower(), CSV)
+	if fmt in [JSON, JSONL, CSV, TSV]:
+		rows = (collections.OrderedDict([(field, columns[field][i]) for field in fields]) for i in selected)
+		if filename == None:
+			writerows(fmt, fields, rows, sys.stdout)
+			return True
 
-	# Calculate column widths
-	for field in fields:
 		try:
-			widest = len(max(data[field], key=len))
-		except:
-			widest = 0
+			f = open(filename, "wb")
+		except IOError, e:
+			print "Unable to open '%s' - %s" % (filename, e.strerror)
+			return False
+		try:
+			writerows(fmt, fields, rows, f)
+		finally:
+			f.close()
+		return True
 
-		widths[field] = max([widest, len(field)])
+	data = [[reporttext(columns[field][i]) for field in fields] for i in selected]
 
-	# Zip and sort
-	data = zip(*consol(data))
-	data.sort()
+	# Calculate column widths
+	widths = []
+	for i in range(len(fields)):
+		widest = 0
+		if len(data):
+			widest = max([len(line[i]) for line in data])
+		widths.append(max([widest, len(fields[i])]))
 
 	# Print title
 	print
-	for field in fields:
-		if field != key:
-			print ("%%-%ds " % widths[field]) % field,
+	for i in range(len(fields)):
+		print ("%%-%ds " % widths[i]) % fields[i],
 	print
-	for field in fields:
-		if field != key:
-			print "-" * widths[field] + " ",
+	for i in range(len(fields)):
+		print "-" * widths[i] + " ",
 	print
 
 	# Print data
 	for line in data:
-		if line == None: continue
-
 		for i in range(len(fields)):
-			if fields[i] != key:
-				print ("%%-%ds " % widths[fields[i]]) % line[i],
+			print ("%%-%ds " % widths[i]) % line[i],
 		print
 	print
 
@@ -8878,6 +10047,13 @@ def setvar(cmd):
 				print "Permissible values are 'idrac' or 'cmc'. Setting $DEVICE to idrac"
 				VARIABLES[cmd[0]] = replvars('idrac')
 		
+		elif cmd[0] == TRANSPORT:
+			if cmd[1] in [WSMAN, NATIVE]:
+				VARIABLES[cmd[0]] = cmd[1]
+			else:
+				print "Permissible values are '%s' or '%s'. Setting $TRANSPORT to %s" % (WSMAN, NATIVE, WSMAN)
+				VARIABLES[cmd[0]] = WSMAN
+
 		else:
 			# Any other variable
 			VARIABLES[cmd[0]] = replvars(cmd[1])
@@ -8904,13 +10080,49 @@ def setvar(cmd):
 				print "Boolean value expected for $PROGRAM"
 				VARIABLES[PROGRAM] = False
 
-		if cmd[0] == PORT:
-			# $PORT has to be a numeric value
+		if cmd[0] == MAXELEMENTS:
+			# $MAXELEMENTS has to be a numeric value, 0 for method defaults
 			try:
-				VARIABLES[PORT] = int(VARIABLES[PORT])
+				VARIABLES[MAXELEMENTS] = int(VARIABLES[MAXELEMENTS])
+				if VARIABLES[MAXELEMENTS] < 0:
+					raise ValueError
 			except:
-				# Default initialize to PORTDEFAULT if bad data provided
-				print "Numeric value expected for $PORT"
+				print "Numeric value expected for $MAXELEMENTS"
+				VARIABLES[MAXELEMENTS] = 0
+
+		if cmd[0] in [RETRIES, TIMEOUT]:
+			# $RETRIES and $TIMEOUT have to be numeric values, 0 to turn off
+			try:
+				VARIABLES[cmd[0]] = int(VARIABLES[cmd[0]])
+				if VARIABLES[cmd[0]] < 0:
+					raise ValueError
+			except:
+				print "Numeric value expected for %s" % cmd[0]
+				VARIABLES[cmd[0]] = 0
+
+		if cmd[0] == PARALLEL:
+			# $PARALLEL has to be a positive numeric value
+			try:
+				VARIABLES[PARALLEL] = int(VARIABLES[PARALLEL])
+				if VARIABLES[PARALLEL] < 1:
+					raise ValueError
+			except:
+				print "Numeric value expected for $PARALLEL"
+				VARIABLES[PARALLEL] = PARALLELDEFAULT
+
+		if cmd[0] == TIMER:
+			# $TIMER has to be True, False or detail
+			if not VARIABLES[TIMER] in ["True", "False", DETAIL]:
+				print "Permissible values are 'True', 'False' or '%s'. Setting $TIMER to False" % DETAIL
+				VARIABLES[TIMER] = "False"
+
+		if cmd[0] == PORT:
+			# $PORT has to be a numeric value
+			try:
+				VARIABLES[PORT] = int(VARIABLES[PORT])
+			except:
+				# Default initialize to PORTDEFAULT if bad data provided
+				print "Numeric value expected for $PORT"
 				VARIABLES[PORT] = PORTDEFAULT
 
 	return True
@@ -8929,7 +10141,7 @@ def sleep(cmd):
 		print "\nRequire 1 argument"
 		return None
 
-	time.sleep(t)
+	idle(t)
 
 	return True
 
@@ -8997,7 +10209,7 @@ def until(cmd):
 	clock = time.clock()
 	while True:
 		if VARIABLES[VERBOSE] > VERBOSE_WSMAN:
-			print "%s: %s" % (time.ctime(), method)
+			print >> echoout(), "%s: %s" % (time.ctime(), method)
 		run(method)
 		if OUTPUT == "":
 			ret = False
@@ -9012,14 +10224,14 @@ def until(cmd):
 				break
 
 		if VARIABLES[VERBOSE] > VERBOSE_WSMAN:
-			print "  Until: %s != %s" % (cond[0], cond[1]),
+			print >> echoout(), "  Until: %s != %s" % (cond[0], cond[1]),
 			if VAR_UNTIL in VARIABLES.keys():
-				print " [%s]\n" % VARIABLES[VAR_UNTIL]
+				print >> echoout(), " [%s]\n" % VARIABLES[VAR_UNTIL]
 				del VARIABLES[VAR_UNTIL]
 			else:
 				print
 
-		time.sleep(check)
+		idle(check)
 
 		if time.clock() - clock > total:
 			print "Until: Timed out!"
@@ -9099,34 +10311,129 @@ def replvars(cmd):
 	# Restore escaped $
 	return cmd.replace("###DOLLAR###", "$")
 
-def xmltoplain(obj, depth=''):
-	offset = "  "
-	out = ""
-	for e in obj.childNodes:
-		if e.nodeType == e.ELEMENT_NODE:
-			if e.localName == "Selector":
-				if e.hasAttributes():
-					for attr in e.attributes.items():
-						out += depth + attr[1]
-			elif e.localName in ["Results", "Envelope", "Body", "PullResponse", "Items", "EnumerateResponse"]:
-				offset = ""
-			elif e.localName in ["Header", "EndOfSequence", "EnumerationContext"]:
-				continue
-			else:
-				out += depth + e.localName.__str__()
+# Elements not shown in plain text, their children are
+PLAINWRAPPERS = ["Results", "Envelope", "Body", "PullResponse", "Items", "EnumerateResponse"]
 
-			if e.firstChild != None and e.firstChild.nodeType == e.TEXT_NODE:
-				data = e.firstChild.data.strip()
-				if data != "":
-					out += " = " + data
+# Elements not shown in plain text, neither are their children
+PLAINSKIPPED = ["Header", "EndOfSequence", "EnumerationContext"]
 
-			out += "\n"
+def xmltoplain(record, depth=''):
+	out = []
+	plainlines(record, depth, out)
+	return "".join(out)
 
-		out += xmltoplain(e, depth+offset)
+# Append the plain text of record to out, piece by piece
+def plainlines(record, depth, out):
+	offset = "  "
+	last = len(record.fields) - 1
+	for i in range(last + 1):
+		e = record.fields[i]
+		name = fieldname(e)
+		if name in PLAINWRAPPERS:
+			offset = ""
+		elif name in PLAINSKIPPED:
+			continue
+		else:
+			out.append(depth)
+			out.append(name)
+
+		if type(e) is tuple:
+			if e[1] != "":
+				out.append(" = ")
+				out.append(e[1])
+			out.append("\n")
+		else:
+			out.append("\n")
+			plainlines(e, depth+offset, out)
+
+		if depth == "" and i < last:
+			out.append("\n")
+
+# Plain text of a response, a blank line after each instance
+def plaintext(record):
+	text = re.sub("\n\n+", "\n\n", xmltoplain(record)).strip()
+	if text != "":
+		text = text + "\n\n"
+	return text
+
+# Properties of an instance by name, values of a repeated name in a list
+#   Records below are nested, flat puts their properties in the instance
+def instancedict(instance, flat=False):
+	props = collections.OrderedDict()
+	if type(instance) is tuple:
+		props[instance[0]] = instance[1]
+		return props
+
+	def add(name, value):
+		if not name in props:
+			props[name] = value
+		elif type(props[name]) == types.ListType:
+			props[name].append(value)
+		else:
+			props[name] = [props[name], value]
 
-		if depth == "" and e.nextSibling != None:
-			out += "\n"
-	return out
+	if flat:
+		for record, field in walkrecords(instance):
+			if type(field) is tuple:
+				add(field[0], field[1])
+	else:
+		for field in instance.fields:
+			if type(field) is tuple:
+				add(field[0], field[1])
+			else:
+				add(field.name, instancedict(field))
+
+	return props
+
+# Write rows, dictionaries of values by field, to out one at a time as
+# json, jsonl, csv or tsv
+def writerows(fmt, fields, rows, out):
+	if fmt in [CSV, TSV]:
+		def cell(value):
+			if type(value) in [types.ListType, types.TupleType]:
+				value = ",".join(value)
+			if type(value) == types.UnicodeType:
+				value = value.encode("utf-8")
+			return value
+
+		writer = csv.writer(out, delimiter={CSV: ",", TSV: "\t"}[fmt], lineterminator="\n")
+		writer.writerow(fields)
+		for row in rows:
+			writer.writerow([cell(row.get(field, "")) for field in fields])
+	elif fmt == JSONL:
+		for row in rows:
+			out.write(json.dumps(row) + "\n")
+	else:
+		separator = "[\n"
+		for row in rows:
+			out.write(separator + json.dumps(row))
+			separator = ",\n"
+		if separator == "[\n":
+			out.write("[]\n")
+		else:
+			out.write("\n]\n")
+
+# Write each instance of a response to out as json, jsonl, csv or tsv
+#   _class is the name of the instance so that a Fault can be told from results
+def writeinstances(fmt, record, out):
+	def row(instance, flat=False):
+		props = collections.OrderedDict([("_class", fieldname(instance))])
+		props.update(instancedict(instance, flat))
+		return props
+
+	if fmt in [CSV, TSV]:
+		# Columns are all properties, in the order first seen
+		fields = ["_class"]
+		seen = {}
+		for instance in instances(record):
+			for name in instancedict(instance, True).keys():
+				if not name in seen:
+					seen[name] = True
+					fields.append(name)
+
+		writerows(fmt, fields, (row(i, True) for i in instances(record)), out)
+	else:
+		writerows(fmt, None, (row(i) for i in instances(record)), out)
 
 # Print commands with password replaced with ******
 def securecmd(cmd):
@@ -9152,26 +10459,25 @@ def securecmd(cmd):
 
 	return cmd
 
+# Command echoes and progress, kept out of stdout when it carries json, jsonl, csv or tsv rows
+def echoout(fmt=None):
+	if fmt == None:
+		fmt = VARIABLES.get(FORMAT)
+	if fmt in [JSON, JSONL, CSV, TSV]:
+		return sys.stderr
+	return sys.stdout
+
 def get_fields():
-	x = OUTPUTXMLOBJ
+	x = OUTPUTTREE
 
 	fields = []
 	if x == None:
 		return fields
 
-	if x.childNodes == None or len(x.childNodes) == 0:
-		return fields
-
-	def recurse_fields(node):
-		name = node.nodeName.encode("ascii").split(":")
-		if len(name) == 2 and not "DCIM_" in name[1] and not name[1] in fields:
-			fields.append(name[1])
-
-		for node in node.childNodes:
-			recurse_fields(node)
-
-	for attr in x.childNodes[0].childNodes:
-		recurse_fields(attr)
+	# First name is the top level element
+	for name in x.names()[1:]:
+		if not "DCIM_" in name:
+			fields.append(name)
 
 	return fields
 
@@ -9466,6 +10772,15 @@ def parseargs(cmdline=sys.argv):
 	
 	# Run in background and exit on completion
 	silent = False
+
+	# Run multiple IPs as threads within this process
+	threaded = False
+
+	# Adapt the number of parallel instances, -pX is the maximum
+	adaptive = False
+
+	# Write Prometheus metrics to this file, or serve them on this port with --serve
+	metrics = None
 	
 	# Order of execution
 	#   Args - load all settings on command line
@@ -9511,6 +10826,15 @@ def parseargs(cmdline=sys.argv):
 			quit = True
 			silent = True
 
+		elif i == "-t":
+			threaded = True
+
+		elif i == "-a":
+			adaptive = True
+
+		elif i[:2] == "-m" and not "=" in i:
+			metrics = i[2:]
+
 		else:
 			# Name=Value settings on the command line
 			arg = re.findall("(.+?)=(.+)", i)
@@ -9542,47 +10866,744 @@ def parseargs(cmdline=sys.argv):
 	if quit == True and not len(wins):
 		cmds.append("quit")
 
-	return [ips, args, wins, cmds, close, silent, parallel]
+	return [ips, args, wins, cmds, close, silent, parallel, threaded, adaptive, metrics]
 
 # Load all arguments as variables within Recite
 def loadargs(args):
 	global VARIABLES
 	global VERBOSE
 
+	# FORMAT=... later on the line still decides where the echoes before it go
+	fmt = None
+	for arg in args:
+		sarg = arg.split("=", 1)
+		if len(sarg) == 2 and "$" + sarg[0] == FORMAT:
+			fmt = sarg[1]
+
 	for arg in args:
 		sarg = arg.split("=", 1)
 		if len(sarg) == 2:
 			s = "Set $%s %s" % (sarg[0], sarg[1])
 			if VARIABLES[VERBOSE] > VERBOSE_WSMAN:
-				print securecmd(s)
+				print >> echoout(fmt), securecmd(s)
 			
 			# Call the internal set function
 			setvar(s)
 		else:
 			print "Skipping malformed argument %s" % arg
 
+###
+# Native WS-MAN transport
+
+class WSManError(Exception):
+	pass
+
+# Keep-alive HTTPS connections per (IP, port, login)
+class ConnectionPool(object):
+	def __init__(self, size=POOLSIZEDEFAULT, idle=POOLIDLEDEFAULT):
+		self.size = size
+		self.idle = idle
+		self.cond = threading.Condition()
+		self.free = {}
+		self.busy = {}
+
+	def connect(self, key):
+		if ssl != None and hasattr(ssl, "_create_unverified_context"):
+			# Same as wsman -V -v, iDRAC certificates are self-signed
+			return httplib.HTTPSConnection(key[0], key[1], context=ssl._create_unverified_context())
+		return httplib.HTTPSConnection(key[0], key[1])
+
+	# Connection is reusable if still open and nothing unexpected is waiting to be read
+	def healthy(self, conn):
+		if conn.sock == None:
+			return False
+
+		try:
+			readable = select.select([conn.sock], [], [], 0)[0]
+		except:
+			return False
+
+		return not len(readable)
+
+	# Close connections idle for longer than allowed
+	def evict(self):
+		now = time.time()
+		for key in self.free.keys():
+			keep = []
+			for conn, used in self.free[key]:
+				if now - used > self.idle:
+					conn.close()
+				else:
+					keep.append((conn, used))
+
+			if len(keep):
+				self.free[key] = keep
+			else:
+				del self.free[key]
+
+	# Returns a connection and whether it was reused, waits if host is at its cap
+	def get(self, key):
+		self.cond.acquire()
+		try:
+			self.evict()
+			while True:
+				free = self.free.get(key, [])
+				while len(free):
+					conn, used = free.pop()
+					if self.healthy(conn):
+						self.busy[key] = self.busy.get(key, 0) + 1
+						return conn, True
+					conn.close()
+
+				if self.busy.get(key, 0) < self.size:
+					self.busy[key] = self.busy.get(key, 0) + 1
+					return self.connect(key), False
+
+				self.cond.wait()
+		finally:
+			self.cond.release()
+
+	def put(self, key, conn, reuse=True):
+		self.cond.acquire()
+		try:
+			self.busy[key] -= 1
+			if reuse and conn.sock != None:
+				self.free.setdefault(key, []).append((conn, time.time()))
+			else:
+				conn.close()
+			self.cond.notify()
+		finally:
+			self.cond.release()
+
+	def close(self):
+		self.cond.acquire()
+		try:
+			for key in self.free.keys():
+				for conn, used in self.free[key]:
+					conn.close()
+			self.free = {}
+		finally:
+			self.cond.release()
+
+POOL = ConnectionPool()
+atexit.register(POOL.close)
+
+# Split catalog URL into resource URI and selectors
+def getresource(url):
+	selectors = []
+
+	url = url.split("?")
+	resource = url.pop(0)
+	if not "http://" in resource:
+		resource = CIMSCHEMA + resource[4:]
+
+	for selector in re.split("[+,]", "+".join(url)):
+		selector = selector.split("=", 1)
+		if len(selector) == 2:
+			selectors.append((selector[0], selector[1].strip("'")))
+
+	return resource, selectors
+
+def buildselectorset(selectors):
+	if not len(selectors):
+		return ""
+
+	escape = xml.sax.saxutils.escape
+	return SELECTORSET % "\n".join([SELECTORREF % (name, escape(value)) for name, value in selectors])
+
+def buildenvelope(wsreq, resource, selectors, action, body):
+	to = "https://%s:%s/wsman" % (wsreq["ip"], wsreq["port"])
+	return ENVELOPE % (to, resource, ANONYMOUS, action, uuid.uuid4(), buildselectorset(selectors), body)
+
+# Send SOAP envelope to the WS-MAN service, returns HTTP status and response
+def wsmanpost(wsreq, envelope):
+	key = (wsreq["ip"], wsreq["port"], wsreq["login"])
+	headers = {
+		"Content-Type": "application/soap+xml;charset=UTF-8",
+		"Authorization": "Basic %s" % base64.b64encode("%s:%s" % (wsreq["login"], wsreq["password"]))
+	}
+
+	while True:
+		start = time.time()
+		conn, reused = POOL.get(key)
+
+		# Whole method has to complete by its deadline, the connection is shut
+		# down if a response is still trickling in then
+		expired = []
+		timer = None
+		conn.timeout = None
+		if wsreq["deadline"] != None:
+			conn.timeout = wsreq["deadline"] - start
+			if conn.timeout <= 0:
+				POOL.put(key, conn)
+				raise socket.timeout("timed out")
+
+			def expire(conn=conn):
+				expired.append(True)
+				try:
+					conn.sock.shutdown(socket.SHUT_RDWR)
+				except:
+					pass
+			timer = threading.Timer(conn.timeout, expire)
+			timer.setDaemon(True)
+			timer.start()
+		if conn.sock != None:
+			conn.sock.settimeout(conn.timeout)
+
+		try:
+			try:
+				if conn.sock == None:
+					conn.connect()
+				connected = time.time()
+				conn.request("POST", "/wsman", envelope, headers)
+				resp = conn.getresponse()
+				responded = time.time()
+				data = resp.read()
+			finally:
+				if timer != None:
+					timer.cancel()
+		except (httplib.HTTPException, socket.error), e:
+			POOL.put(key, conn, False)
+			if len(expired):
+				raise socket.timeout("timed out")
+			if reused and not timedout(e):
+				# Service dropped the kept-alive connection, retry on a new one
+				continue
+			raise
+		except:
+			POOL.put(key, conn, False)
+			raise
+
+		if len(expired):
+			# Shut down just as the response completed
+			POOL.put(key, conn, False)
+			raise socket.timeout("timed out")
+
+		POOL.put(key, conn)
+		addphase(wsreq["phases"], "connect", connected - start)
+		addphase(wsreq["phases"], "wait", responded - connected)
+		addphase(wsreq["phases"], "transfer", time.time() - responded)
+		return resp.status, data
+
+# SSL reads report timeouts as SSLError rather than socket.timeout
+def timedout(e):
+	return isinstance(e, socket.timeout) or "timed out" in str(e)
+
+# SOAP faults are returned as is, like the wsman CLI does
+def wsmanpage(status, data):
+	if not status in [200, 400, 500]:
+		raise WSManError("Connection failed. response code = %d" % status)
+
+	if re.match('\s*<\?xml version=.*?>', data) == None:
+		data = '<?xml version="1.0" encoding="UTF-8"?>\n' + data
+
+	return data
+
+def nativeget(wsreq, resource, selectors):
+	status, data = wsmanpost(wsreq, buildenvelope(wsreq, resource, selectors, ACTION_GET, ""))
+	return [wsmanpage(status, data)]
+
+# Get instance, update specified properties and put it back
+def nativeset(wsreq, resource, selectors):
+	status, data = wsmanpost(wsreq, buildenvelope(wsreq, resource, selectors, ACTION_GET, ""))
+	if status != 200:
+		return [wsmanpage(status, data)]
+
+	x = xml.dom.minidom.parseString(data)
+	instance = None
+	for body in x.getElementsByTagNameNS(SOAPENV, "Body"):
+		for node in body.childNodes:
+			if node.nodeType == node.ELEMENT_NODE:
+				instance = node
+				break
+
+	if instance == None:
+		raise WSManError("Get failed, no instance returned for %s" % resource)
+
+	for name, val in wsreq["params"]:
+		for node in instance.childNodes:
+			if node.nodeType == node.ELEMENT_NODE and node.localName == name:
+				while node.firstChild != None:
+					node.removeChild(node.firstChild)
+				node.appendChild(x.createTextNode(val))
+
+	status, data = wsmanpost(wsreq, buildenvelope(wsreq, resource, selectors, ACTION_PUT, instance.toxml()))
+	return [wsmanpage(status, data)]
+
+def nativeinvoke(wsreq, resource, selectors, inputxml):
+	if not inputxml:
+		escape = xml.sax.saxutils.escape
+		params = "".join(["  <p:%s>%s</p:%s>\r\n" % (name, escape(val), name) for name, val in wsreq["params"]])
+		inputxml = INVOKEINPUT % (wsreq["action"], resource, params, wsreq["action"])
+
+	action = "%s/%s" % (resource, wsreq["action"])
+	status, data = wsmanpost(wsreq, buildenvelope(wsreq, resource, selectors, action, inputxml))
+	return [wsmanpage(status, data)]
+
+# Enumerate and pull until end of sequence, yields one page per response
+def nativeenumerate(wsreq, resource, selectors):
+	items = []
+	if wsreq["filter"] != None:
+		if "associationFilter" in wsreq["dialect"]:
+			oresource, oselectors = getresource(wsreq["filter"])
+			items.append(ASSOCFILTER % (wsreq["dialect"], ANONYMOUS, oresource, buildselectorset(oselectors)))
+		else:
+			items.append(FILTER % (wsreq["dialect"], xml.sax.saxutils.escape(wsreq["filter"])))
+
+	if wsreq["epr"]:
+		items.append("      <w:EnumerationMode>EnumerateEPR</w:EnumerationMode>")
+
+	pull = ""
+	if wsreq["maxelements"]:
+		# Optimized enumeration returns the first items with the enumerate response
+		items.append("      <w:OptimizeEnumeration/>")
+		items.append("      <w:MaxElements>%d</w:MaxElements>" % wsreq["maxelements"])
+		pull = "      <n:MaxElements>%d</n:MaxElements>" % wsreq["maxelements"]
+
+	status, data = wsmanpost(wsreq, buildenvelope(wsreq, resource, selectors, ACTION_ENUMERATE, ENUMERATE % "\n".join(items)))
+	while True:
+		yield wsmanpage(status, data)
+		if status != 200 or re.search("<(\w+:)?EndOfSequence", data) != None:
+			break
+
+		context = re.search("<(?:\w+:)?EnumerationContext[^>]*>(.*?)</", data, re.S)
+		if context == None:
+			break
+
+		status, data = wsmanpost(wsreq, buildenvelope(wsreq, resource, selectors, ACTION_PULL, PULL % (context.group(1), pull)))
+
+# Run WS-MAN request in process, yields each response the same as the wsman CLI prints it
+#   Timeouts fail the method, as do breaker skips in transportpages()
+def nativepages(wsreq, inputxml=""):
+	resource, selectors = getresource(wsreq["url"])
+	if wsreq["timeout"]:
+		wsreq["deadline"] = time.time() + wsreq["timeout"]
+
+	try:
+		if wsreq["command"] == "identify":
+			status, data = wsmanpost(wsreq, IDENTIFY)
+			pages = [wsmanpage(status, data)]
+		elif wsreq["command"] == "get":
+			pages = nativeget(wsreq, resource, selectors)
+		elif wsreq["command"] == "set":
+			pages = nativeset(wsreq, resource, selectors)
+		elif wsreq["command"] == "invoke":
+			pages = nativeinvoke(wsreq, resource, selectors, inputxml)
+		elif wsreq["command"] == "enumerate":
+			pages = nativeenumerate(wsreq, resource, selectors)
+		else:
+			raise WSManError("Unsupported command '%s'" % wsreq["command"])
+
+		for page in pages:
+			yield page
+	except WSManError, e:
+		yield "%s\n" % e
+	except Exception, e:
+		if timedout(e):
+			wsreq["failed"] = True
+			yield "Timed out after %d seconds\n" % wsreq["timeout"]
+		else:
+			yield "Connection failed. %s\n" % e
+
+###
+# Metrics
+
+# Prometheus metric families, in the order they are written
+METRICFAMILIES = [
+	("recite_command_duration_seconds", "histogram", "Time taken by WS-MAN commands"),
+	("recite_response_bytes_total", "counter", "Bytes received in WS-MAN responses"),
+	("recite_retries_total", "counter", "WS-MAN commands retried after a connection failure or timeout"),
+	("recite_failures_total", "counter", "WS-MAN commands that failed or returned a fault")
+]
+
+# Per host and method command statistics in Prometheus text format
+#   Every series is a sum, so files from several instances merge by adding them up
+class Metrics(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.series = {}
+		self.order = []
+
+	def add(self, family, name, labels, value):
+		key = "%s{%s}" % (name, labels)
+		if not key in self.series:
+			self.series[key] = 0
+			self.order.append((family, key))
+		self.series[key] += value
+
+	def observe(self, host, method, seconds, size, retries, failed):
+		labels = 'host="%s",method="%s"' % (host.replace("\\", "\\\\").replace('"', '\\"'), method)
+		family = METRICFAMILIES[0][0]
+
+		self.lock.acquire()
+		try:
+			for bucket in METRICBUCKETS:
+				self.add(family, family + "_bucket", labels + ',le="%g"' % bucket, int(seconds <= bucket))
+			self.add(family, family + "_bucket", labels + ',le="+Inf"', 1)
+			self.add(family, family + "_sum", labels, seconds)
+			self.add(family, family + "_count", labels, 1)
+			self.add(METRICFAMILIES[1][0], METRICFAMILIES[1][0], labels, size)
+			self.add(METRICFAMILIES[2][0], METRICFAMILIES[2][0], labels, retries)
+			self.add(METRICFAMILIES[3][0], METRICFAMILIES[3][0], labels, int(failed))
+		finally:
+			self.lock.release()
+
+	# Add series from text written by another instance
+	def merge(self, text):
+		self.lock.acquire()
+		try:
+			for line in text.split("\n"):
+				match = re.match("(\w+)\{(.*)\} (\S+)$", line)
+				if match == None:
+					continue
+
+				name, labels, value = match.groups()
+				for family, kind, description in METRICFAMILIES:
+					if name == family or name.startswith(family + "_"):
+						self.add(family, name, labels, float(value))
+						break
+		finally:
+			self.lock.release()
+
+	def render(self):
+		self.lock.acquire()
+		try:
+			lines = []
+			for family, kind, description in METRICFAMILIES:
+				lines.append("# HELP %s %s" % (family, description))
+				lines.append("# TYPE %s %s" % (family, kind))
+				for name, key in self.order:
+					if name == family:
+						value = self.series[key]
+						if value == int(value):
+							# Counts read back from files are floats
+							value = int(value)
+						lines.append("%s %s" % (key, value))
+			return "\n".join(lines) + "\n"
+		finally:
+			self.lock.release()
+
+	def write(self, filename):
+		try:
+			fp = open(filename, "w")
+			fp.write(self.render())
+			fp.close()
+		except IOError, e:
+			print "Unable to write metrics to %s: %s" % (filename, e)
+
+# Collect metrics for this process, written to filename on exit
+def startmetrics(filename=None):
+	global METRICS
+
+	METRICS = Metrics()
+	if filename != None:
+		atexit.register(METRICS.write, filename)
+
+###
+# Sessions
+
+# Only one session runs Recite code at a time, it is released while waiting on
+# the network or sleeping so that other sessions can proceed
+#   Reentrant so that a session can run another one from within
+ENGINE = threading.RLock()
+SESSIONLOCAL = threading.local()
+
+# Independent Recite instance that can run in the background
+class Session(object):
+	def __init__(self, args=[], stdout=None):
+		if stdout == None:
+			stdout = sys.stdout
+
+		# Start with a copy of the current settings, not those of a session
+		# running in another thread
+		ENGINE.acquire()
+		try:
+			variables = copy.deepcopy(VARIABLES)
+		finally:
+			ENGINE.release()
+
+		self.state = {
+			"BATCH": [],
+			"CONTEXT": None,
+			"GOTO": None,
+			"INPUT": "",
+			"INPUTXML": "",
+			"LOGGER": None,
+			"OUTPUT": "",
+			"OUTPUTXML": "",
+			"OUTPUTXMLOBJ": None,
+			"OUTPUTTREE": None,
+			"OUTPUTPAGES": [],
+			"PHASES": {},
+			"RETURN": [],
+			"VARIABLES": variables
+		}
+		self.stdout = stdout
+		self.saved = None
+		self.thread = None
+		self.ret = None
+		self.limiter = None
+
+		if len(args):
+			self.run(loadargs, args)
+
+	# Swap session state into the module globals
+	def enter(self):
+		ENGINE.acquire()
+		g = globals()
+		self.saved = {}
+		for name in SESSION_STATE:
+			self.saved[name] = g[name]
+			g[name] = self.state[name]
+		self.saved["stdout"] = sys.stdout
+		sys.stdout = self.stdout
+
+	# Swap session state out and restore what was there before
+	def leave(self):
+		g = globals()
+		for name in SESSION_STATE:
+			self.state[name] = g[name]
+			g[name] = self.saved[name]
+		self.stdout = sys.stdout
+		sys.stdout = self.saved["stdout"]
+		self.saved = None
+		ENGINE.release()
+
+	# Run a Recite command in this session, returns the same as process()
+	def run(self, cmd, *args):
+		caller = getattr(SESSIONLOCAL, "session", None)
+		SESSIONLOCAL.session = self
+		self.enter()
+		try:
+			if callable(cmd):
+				return cmd(*args)
+			return process(cmd)
+		finally:
+			self.leave()
+			SESSIONLOCAL.session = caller
+
+	# Run a Recite command in a background thread
+	def start(self, cmd):
+		def target():
+			self.ret = self.run(cmd)
+
+		self.wait()
+		self.ret = None
+		self.thread = threading.Thread(target=target)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+
+	def done(self):
+		return self.thread == None or not self.thread.isAlive()
+
+	# Wait for the background command to complete and return its result
+	def wait(self, timeout=None):
+		if self.thread != None:
+			self.thread.join(timeout)
+			if self.thread.isAlive():
+				return None
+			self.thread = None
+		return self.ret
+
+	def get_output(self):
+		if self.state["OUTPUT"] == None:
+			self.state["OUTPUT"] = plaintext(self.state["OUTPUTTREE"])
+		return self.state["OUTPUT"]
+
+	def get_outputxml(self):
+		return self.state["OUTPUTXML"]
+
+	def get_variable(self, name):
+		return self.state["VARIABLES"].get(name)
+
+# Wait for all sessions to complete, returns their results in order
+def waitall(sessions):
+	return [session.wait() for session in sessions]
+
+# Yield pages from the transport with the engine released while waiting
+def released(pages):
+	session = getattr(SESSIONLOCAL, "session", None)
+	try:
+		if session == None:
+			for page in pages:
+				yield page
+			return
+
+		while True:
+			session.leave()
+			try:
+				try:
+					page = pages.next()
+				except StopIteration:
+					return
+			finally:
+				session.enter()
+			yield page
+	finally:
+		pages.close()
+
+# Sleep with the engine released
+def idle(seconds):
+	session = getattr(SESSIONLOCAL, "session", None)
+	if session != None:
+		session.leave()
+	try:
+		time.sleep(seconds)
+	finally:
+		if session != None:
+			session.enter()
+
+# Run tasks on at most n threads at a time, returns once all are done
+#   With a limiter, n is the maximum and the limiter decides how many run
+def runpool(tasks, n, limiter=None):
+	tasks = list(tasks)
+	lock = threading.Lock()
+
+	def worker():
+		while True:
+			if limiter != None:
+				limiter.acquire()
+			try:
+				lock.acquire()
+				try:
+					if not len(tasks):
+						return
+					task = tasks.pop(0)
+				finally:
+					lock.release()
+				task()
+			finally:
+				if limiter != None:
+					limiter.release()
+
+	# Tasks run their own sessions, release the caller's until they are done
+	session = getattr(SESSIONLOCAL, "session", None)
+	if session != None:
+		session.leave()
+	try:
+		threads = []
+		for i in range(max(1, min(n, len(tasks)))):
+			thread = threading.Thread(target=worker)
+			thread.setDaemon(True)
+			thread.start()
+			threads.append(thread)
+
+		# Join with a timeout so that CTRL-C still gets through
+		for thread in threads:
+			while thread.isAlive():
+				thread.join(0.5)
+	finally:
+		if session != None:
+			session.enter()
+
 ###
 # Execution
 
+# Adaptive parallel limit for -a, up to -pX
+#   Grows while commands complete without errors and in less than twice the usual
+#   time, halves when they don't. Only one decrease per batch of commands in flight
+class Limiter(object):
+	def __init__(self, maximum, minimum=1):
+		self.maximum = max(minimum, maximum)
+		self.minimum = minimum
+		self.limit = float(max(minimum, self.maximum / 4))
+		self.running = 0
+		self.latency = None
+		self.slowstart = True
+		self.holdoff = 0
+		self.cond = threading.Condition()
+
+	# Wait for a slot under the current limit
+	def acquire(self):
+		self.cond.acquire()
+		try:
+			while self.running >= int(self.limit):
+				self.cond.wait(0.5)
+			self.running += 1
+		finally:
+			self.cond.release()
+
+	def release(self):
+		self.cond.acquire()
+		try:
+			self.running -= 1
+			self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	# Record how long a command took and whether it succeeded
+	def observe(self, latency, ok):
+		self.cond.acquire()
+		try:
+			slow = self.latency != None and latency > 2 * self.latency
+			if ok:
+				if self.latency == None:
+					self.latency = latency
+				else:
+					self.latency = 0.8 * self.latency + 0.2 * latency
+
+			if self.holdoff:
+				self.holdoff -= 1
+
+			if ok and not slow:
+				# Double every round trip until the first backoff, then add one
+				if self.slowstart:
+					self.limit += 1
+				else:
+					self.limit += 1.0 / self.limit
+				self.limit = min(self.limit, self.maximum)
+			elif not self.holdoff:
+				self.limit = max(self.minimum, self.limit / 2)
+				self.slowstart = False
+				self.holdoff = self.running
+			self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	def __str__(self):
+		return "parallel limit %d" % int(self.limit)
+
+# Current limit shown with progress output
+def limittext(limiter):
+	if limiter == None:
+		return ""
+	return " (%s)" % limiter
+
 # Poll parallel Recite threads until they exit or 
-def pollprocs(procs, parallel=1):
+def pollprocs(procs, parallel=1, limiter=None):
 	# Ensure only n parallel threads run at a time
-	while len(procs) >= parallel:
+	#   With a limiter, it decides n unless waiting for all to complete
+	while True:
+		n = parallel
+		if limiter != None and parallel > 1:
+			n = int(limiter.limit)
+		if len(procs) < n:
+			break
+
 		time.sleep(0.5)
 
 		for ip in procs.keys():
 			# If process has completed, cleanup and delete from procs
 			if procs[ip][0].poll() != None:
+				# Exit code is that of the window instead of Recite unless silent
+				if limiter != None:
+					limiter.observe(time.time() - procs[ip][0].started, procs[ip][0].returncode == 0)
 				if len(procs[ip]) > 1:
 					procs[ip][1].close()
 				del procs[ip]
-				print "Completed for %s" % ip
+				print "Completed for %s%s" % (ip, limittext(limiter))
 
 # Kick off multiple parallel instances of Recite - one per IP
-def multiply(ips, args, wins, cmds, close=False, silent=False, parallel=10, delay=0):
+def multiply(ips, args, wins, cmds, close=False, silent=False, parallel=10, delay=0, limiter=None):
 	# Keep track of child process handles and file descriptors
 	procs = {}
 
+	# Each instance writes its own metrics, merged once all are done
+	metricsdir = None
+	if METRICS != None:
+		metricsdir = tempfile.mkdtemp()
+
 	# Handle multiple IPs
 	for ip in ips:
 		if "win" in sys.platform:
@@ -9624,6 +11645,8 @@ def multiply(ips, args, wins, cmds, close=False, silent=False, parallel=10, dela
 		cmd.extend(args)
 		cmd.extend(wins)
 		cmd.extend(cmds)
+		if metricsdir != None:
+			cmd.append("-m%s" % os.path.join(metricsdir, "%s.prom" % ip))
 
 		for i in range(len(cmd)):
 			# Escaping " with \"
@@ -9649,7 +11672,8 @@ def multiply(ips, args, wins, cmds, close=False, silent=False, parallel=10, dela
 			proc = subprocess.Popen(cmd, shell=True, stdout=procs[ip][0], stderr=subprocess.STDOUT)
 
 		# Save the process handle in procs
-		print "Started for %s" % ip
+		print "Started for %s%s" % (ip, limittext(limiter))
+		proc.started = time.time()
 		procs[ip].insert(0, proc)
 
 		# If delay specified between spawns
@@ -9657,88 +11681,541 @@ def multiply(ips, args, wins, cmds, close=False, silent=False, parallel=10, dela
 			time.sleep(delay)
 
 		# Poll to see if any open slots available for parallelization
-		pollprocs(procs, parallel)
+		pollprocs(procs, parallel, limiter)
 
 	# Wait until last batch of processes complete
-	pollprocs(procs)
+	pollprocs(procs, 1, limiter)
+
+	if metricsdir != None:
+		for filename in glob.glob(os.path.join(metricsdir, "*.prom")):
+			fp = open(filename)
+			METRICS.merge(fp.read())
+			fp.close()
+		shutil.rmtree(metricsdir)
+
+# Run one session against an IP, output goes to the log file in silent mode
+def fanouthost(ip, args, wins, cmds, silent=False, limiter=None):
+	if silent:
+		out = open("%s.log" % ip, "a")
+		out.seek(0, os.SEEK_END)
+	else:
+		out = StringIO.StringIO()
+
+	try:
+		session = Session(["IP=%s" % ip] + args, stdout=out)
+		session.limiter = limiter
+		ret = True
+		for cmd in cmds:
+			ret = session.run(cmd)
+			if ret == None:
+				break
+
+		if ret == True:
+			for win in wins:
+				ret = session.run(batch, win)
+				if ret != True:
+					break
+	except SystemExit:
+		ret = None
+	except Exception, e:
+		out.write("%s\n" % e)
+		ret = False
+
+	if silent:
+		out.close()
+		return ret, ""
+
+	return ret, out.getvalue()
+
+# Run multiple IPs within this process - one session per IP, n at a time
+def fanout(ips, args, wins, cmds, silent=False, parallel=10, console=None, limiter=None):
+	lock = threading.Lock()
+
+	# Sessions swap sys.stdout, progress goes to the console directly
+	if console == None:
+		console = sys.stdout
+
+	def host(ip):
+		lock.acquire()
+		try:
+			console.write("Started for %s%s\n" % (ip, limittext(limiter)))
+		finally:
+			lock.release()
+
+		ret, output = fanouthost(ip, args, wins, cmds, silent, limiter)
+
+		lock.acquire()
+		try:
+			console.write("Completed for %s%s\n" % (ip, limittext(limiter)))
+			if len(output):
+				console.write("\n----- %s -----\n%s\n" % (ip, output.strip()))
+			console.flush()
+		finally:
+			lock.release()
+
+	runpool([lambda ip=ip: host(ip) for ip in ips], parallel, limiter)
+
+# Cassette file for a command - method plus sorted params, -timeout and -retries
+# don't change the response
+def cassettename(command):
+	method, params = parsecmd(command)
+
+	key = [method]
+	for name in sorted(params.keys()):
+		if not name in ["-timeout", "-retries"]:
+			key += ["%s=%s" % (name, value) for value in params[name]]
+
+	return "%s-%s.json" % (method, hashlib.sha1("\n".join(key)).hexdigest()[:16])
+
+# Save the pages of a response as they pass through for $REPLAY
+#   Pages are stored as latin-1 so any bytes come back unchanged
+def recordpages(pages, filename, command, request, inputxml):
+	recorded = []
+	for page in pages:
+		recorded.append(page)
+		yield page
+
+	try:
+		directory = os.path.dirname(filename)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+	except OSError:
+		# Created by another session in the meantime
+		pass
+
+	fp = open(filename, "w")
+	json.dump({
+		"command": command,
+		"request": request,
+		"input": inputxml,
+		"pages": recorded
+	}, fp, encoding="latin-1", indent=1)
+	fp.close()
+
+# Pages of a response saved with $RECORD, no connection is made
+#   Methods without a recording fail like ones that timed out
+def replaypages(filename, wsreq):
+	try:
+		fp = open(filename)
+		cassette = json.load(fp)
+		fp.close()
+	except IOError:
+		wsreq["failed"] = True
+		yield "No recording %s\n" % filename
+		return
+	except ValueError:
+		wsreq["failed"] = True
+		yield "Invalid recording %s\n" % filename
+		return
+
+	for page in cassette["pages"]:
+		yield page.encode("latin-1")
 
 def run(inp):
+	for page in runpages(inp):
+		pass
+
+# Run method and process each response page as it arrives, yields after each page
+#   OUTPUTTREE and OUTPUTPAGES hold the pages processed so far, rest is set once all are in
+def runpages(inp):
 	global FORMAT
 	global INPUT
 	global INPUTXML
 	global OUTPUT
 	global OUTPUTXML
 	global OUTPUTXMLOBJ
+	global OUTPUTTREE
+	global OUTPUTPAGES
 	global LOGFILE
+	global PHASES
 	global VARIABLES
 
 	inputxml = ""
 	output = ""
 	outputxml = ""
-	outputxmlobj = None
-	cmd, method = buildcmd(inp)
+	outputtree = None
+
+	# Variables were replaced by runmethod, GetEPR run by buildcmd starts afresh
+	phases = PHASES
+	PHASES = {}
+	begin = time.time()
+	cmd, method, wsreq = buildcmd(inp)
+
+	INPUT = cmd
+	OUTPUT = output
+	OUTPUTXML = outputxml
+	OUTPUTXMLOBJ = None
+	OUTPUTTREE = outputtree
+
 	if cmd != None:
-		try:
-			if "win" in sys.platform:
-				fname = cmd.split("file:")[1]
-			else:
-				fname = cmd.split("-J ")[1]
-			fp = open(fname)
-			inputxml = fp.read()
-			fp.close()
-		except:
-			pass
+		inputxml = wsreq["input"]
+		INPUTXML = inputxml
 
-		if VARIABLES[VERBOSE] > VERBOSE_QUIET:
-			print securecmd(cmd) + "\n"
-			if inputxml: print inputxml
+		phases["build"] = time.time() - begin
+		wsreq["phases"] = phases
 
-		if TIMER in VARIABLES.keys() and VARIABLES[TIMER] == "True":
-			start = time.time()
-		pipe = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
-		output = pipe.read()
-		pipe.close()
+		if VARIABLES[VERBOSE] > VERBOSE_QUIET:
+			print >> echoout(), securecmd(cmd) + "\n"
+			if inputxml: print >> echoout(), inputxml
 
+		start = time.time()
+		if VARIABLES[REPLAY]:
+			pages = replaypages(os.path.join(VARIABLES[REPLAY], cassettename(inp)), wsreq)
+		else:
+			pages = transportpages(cmd, wsreq, inputxml, VARIABLES[TRANSPORT] == NATIVE)
+			if VARIABLES[RECORD]:
+				pages = recordpages(pages, os.path.join(VARIABLES[RECORD], cassettename(inp)), inp, securecmd(cmd), inputxml)
+		pages = released(pages)
+
+		# Plain text is rendered as pages arrive only if printed, otherwise once asked for
+		render = VARIABLES[VERBOSE] > VERBOSE_QUIET and VARIABLES[FORMAT] == NORMAL
+
+		# Each page is a complete response, multiple pages get wrapped in <Results>
+		texts = []
+		xmls = []
+		OUTPUTPAGES = xmls
+		results = None
+		failed = False
+		complete = False
 		try:
-			outputxml = output
-			if re.search('<\?xml version=.*?>', outputxml) != None:
-				outputxml = "<Results>" + re.sub('<\?xml version=.*?>', '', outputxml) + "</Results>"
-			outputxml = ''.join([i.strip() for i in outputxml.split("\n")])
-			outputxmlobj = xml.dom.minidom.parseString(outputxml)
-			output = xmltoplain(outputxmlobj)
-			output = re.sub("\n\n+", "\n\n", output).strip()
-			if output != "":
-				output = output + "\n\n"
-		except:
-			pass
-
-		if output != "":
+			for page in pages:
+				started = time.time()
+				pagexml = page
+				if re.search('<\?xml version=.*?>', pagexml) != None:
+					pagexml = re.sub('<\?xml version=.*?>', '', pagexml)
+					if results == None:
+						results = Document(DOCUMENT, [Record("Results", [])])
+						results.add(results, results.fields[0])
+				xmls.append(''.join([i.strip() for i in pagexml.split("\n")]))
+
+				try:
+					pagerecord = parserecords(xmls[-1])
+					parsed = time.time()
+					addphase(phases, "parse", parsed - started)
+					text = pagerecord
+					if render:
+						text = plaintext(pagerecord)
+						addphase(phases, "render", time.time() - parsed)
+
+					# DOM is only built if asked for
+					OUTPUTXMLOBJ = None
+					if results != None:
+						results.extend(pagerecord)
+						OUTPUTTREE = results
+					else:
+						OUTPUTTREE = pagerecord
+					pagexml = xmls[-1]
+				except:
+					# Not XML, keep as is
+					pagexml = None
+					text = page
+					failed = True
+
+				texts.append(text)
+				if render and text != "":
+					print text,
+
+				yield pagexml
+			complete = True
+		finally:
+			# Also run if the caller stops early, wsman is not left running
+			pages.close()
+			removeinput(wsreq)
+
+			# Pages without <?xml ?> are not all kept in OUTPUTTREE, render them now
+			if render or failed or (results == None and len(texts) > 1):
+				output = "".join([plaintext(i) if isinstance(i, Record) else i for i in texts])
+			elif next(instances(OUTPUTTREE), None) == None:
+				output = ""
+			else:
+				output = None
+			outputxml = "".join(xmls)
+			if results != None:
+				outputxml = "<Results>" + outputxml + "</Results>"
+			if not failed:
+				outputtree = OUTPUTTREE
+
+			# Transport gave up, its message is shown but the method fails
+			if wsreq["failed"]:
+				if not render and VARIABLES[VERBOSE] > VERBOSE_QUIET:
+					print >> echoout(), output,
+				output = ""
+
+			# Stopped early, the pages read so far are the output
+			if not complete:
+				INPUT = cmd
+				INPUTXML = inputxml
+				OUTPUT = output
+				OUTPUTXML = outputxml
+				OUTPUTTREE = outputtree
+
+		# Normal format was printed page by page
+		if output != "" and VARIABLES[FORMAT] != NORMAL:
 			if VARIABLES[VERBOSE] > VERBOSE_QUIET:
-				if VARIABLES[FORMAT] == NORMAL:
-					print output,
-				elif VARIABLES[FORMAT] == XML:
+				if VARIABLES[FORMAT] == XML:
 					print outputxml + "\n"
 				elif VARIABLES[FORMAT] == PRETTY:
-					print toprettyxml(outputxmlobj)
+					if outputtree != None:
+						writeprettyxml(outputxml, sys.stdout)
+					else:
+						print output,
+				elif VARIABLES[FORMAT] in [JSON, JSONL, CSV, TSV]:
+					if outputtree != None:
+						writeinstances(VARIABLES[FORMAT], outputtree, sys.stdout)
+					else:
+						print >> sys.stderr, output,
 				else:
-					print "Unknown value for $FORMAT. Supported = normal, xml, prettyxml"
+					print "Unknown value for $FORMAT. Supported = normal, xml, prettyxml, json, jsonl, csv, tsv"
+
+		status = "ok"
+		if failed or output == "":
+			status = "failed"
+		elif (LOGFILE != None or METRICS != None) and re.search("<(\w+:)?Fault[ >]", outputxml) != None:
+			status = "fault"
 
 		if LOGFILE != None:
-			fp = open(LOGFILE, "a+")
-			fp.write("%s\n%s\n%s\n\n" % (securecmd(cmd), inputxml, outputxml))
-			fp.close()
+			started = time.time()
+			entry = {
+				"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+				"host": wsreq["ip"],
+				"method": method,
+				"duration": round(started - start, 3),
+				"request_bytes": len(inputxml),
+				"response_bytes": len(outputxml),
+				"retries": wsreq["retried"],
+				"status": status
+			}
+			if LOGFILE.payload:
+				entry["command"] = securecmd(cmd)
+				entry["input"] = inputxml
+				entry["output"] = outputxml
+			LOGFILE.record(entry)
+			addphase(phases, "log", time.time() - started)
 
 		if TIMER in VARIABLES.keys() and VARIABLES[TIMER] == "True":
-			print "TIMER: %s - %d msecs\n" % (method, (time.time() - start) * 1000)
+			print >> echoout(), "TIMER: %s - %d msecs\n" % (method, (time.time() - start) * 1000)
+		elif TIMER in VARIABLES.keys() and VARIABLES[TIMER] == DETAIL:
+			total = (time.time() - begin + phases.get("vars", 0)) * 1000
+			print >> echoout(), "TIMER: %s - %d msecs (%s)\n" % (method, total, ", ".join(["%s %d" % (label, phases.get(phase, 0) * 1000) for phase, label in TIMERPHASES]))
+			TIMINGS.setdefault(method, []).append(total)
+
+		if METRICS != None:
+			METRICS.observe(wsreq["ip"], method, time.time() - start, sum([len(i) for i in xmls]), wsreq["retried"], status != "ok")
+
+		# Fan-out with -a adapts to how hosts respond
+		session = getattr(SESSIONLOCAL, "session", None)
+		if session != None and session.limiter != None:
+			session.limiter.observe(time.time() - start, not failed and output != "")
 
 	INPUT = cmd
 	INPUTXML = inputxml
 	OUTPUT = output
 	OUTPUTXML = outputxml
-	OUTPUTXMLOBJ = outputxmlobj
+	OUTPUTTREE = outputtree
+
+# Add to the time spent in a phase of a command
+def addphase(phases, phase, seconds):
+	phases[phase] = phases.get(phase, 0) + seconds
+
+# Value below which percent of the sorted values fall
+def percentile(values, percent):
+	return values[max(0, int(math.ceil(len(values) * percent / 100.0)) - 1)]
+
+# Per method statistics of commands timed with $TIMER detail, shown on exit
+def timersummary():
+	if not len(TIMINGS):
+		return
+
+	methods = TIMINGS.keys()
+	methods.sort()
+	width = max([len(method) for method in methods] + [len("Method")])
+
+	print "\nTIMER summary (msecs)"
+	print ("%%-%ds %%7s %%9s %%9s %%9s" % width) % ("Method", "Count", "p50", "p95", "Max")
+	print ("%%-%ds %%7s %%9s %%9s %%9s" % width) % ("-" * width, "-" * 7, "-" * 9, "-" * 9, "-" * 9)
+	for method in methods:
+		values = sorted(TIMINGS[method])
+		print ("%%-%ds %%7d %%9d %%9d %%9d" % width) % (method, len(values), percentile(values, 50), percentile(values, 95), values[-1])
+
+atexit.register(timersummary)
+
+# Hosts that fail BREAKERFAILURES commands in a row are skipped for BREAKERRESET
+# seconds, then one command is let through to check if they are back
+class CircuitBreaker(object):
+	def __init__(self, failures=BREAKERFAILURES, reset=BREAKERRESET):
+		self.failures = failures
+		self.reset = reset
+		self.lock = threading.Lock()
+		self.hosts = {}
+
+	def allow(self, key):
+		self.lock.acquire()
+		try:
+			if not key in self.hosts or self.hosts[key][0] < self.failures:
+				return True
+
+			if time.time() - self.hosts[key][1] >= self.reset:
+				# Skip the rest until this one completes
+				self.hosts[key][1] = time.time()
+				return True
+
+			return False
+		finally:
+			self.lock.release()
+
+	def record(self, key, ok):
+		self.lock.acquire()
+		try:
+			if ok:
+				if key in self.hosts:
+					del self.hosts[key]
+			else:
+				if not key in self.hosts:
+					self.hosts[key] = [0, 0]
+				self.hosts[key][0] += 1
+				if self.hosts[key][0] >= self.failures:
+					self.hosts[key][1] = time.time()
+		finally:
+			self.lock.release()
+
+BREAKER = CircuitBreaker()
+
+# Connection failures, timeouts and WS-MAN TimedOut faults are worth retrying
+def retryable(page):
+	if page == None or page.lstrip()[:1] != "<":
+		return True
+	return re.search(">\s*\w+:TimedOut\s*<", page) != None
+
+# Pages from the selected transport
+#   Reads are retried with exponential backoff and jitter if the first page failed,
+#   changes are not since they may have been applied
+def transportpages(cmd, wsreq, inputxml="", native=False):
+	key = (wsreq["ip"], wsreq["port"])
+	if not BREAKER.allow(key):
+		wsreq["failed"] = True
+		yield "Skipped, %s failed %d times in a row. Retrying after %d seconds\n" % (wsreq["ip"], BREAKER.failures, BREAKER.reset)
+		return
+
+	retries = 0
+	if wsreq["command"] in ["get", "enumerate", "identify"]:
+		retries = wsreq["retries"]
+
+	attempt = 0
+	while True:
+		wsreq["failed"] = False
+		if native:
+			pages = nativepages(wsreq, inputxml)
+		else:
+			pages = wsmanpages(cmd, wsreq, inputxml)
+
+		try:
+			page = pages.next()
+		except StopIteration:
+			page = None
+
+		failed = retryable(page)
+		if failed and attempt < retries:
+			pages.close()
+			attempt += 1
+			wsreq["retried"] = attempt
+			time.sleep(random.uniform(0, min(BACKOFFMAX, BACKOFFBASE * 2 ** attempt)))
+			continue
+
+		BREAKER.record(key, not failed)
+		try:
+			if page != None:
+				yield page
+			for page in pages:
+				yield page
+		finally:
+			pages.close()
+		return
+
+def killproc(proc):
+	try:
+		if "win" in sys.platform:
+			# Take down winrm started by cmd.exe as well
+			subprocess.call("taskkill /F /T /PID %d" % proc.pid, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		else:
+			os.killpg(proc.pid, signal.SIGKILL)
+	except:
+		pass
+
+# Run wsman/winrm, yields each XML document in its output as a page
+#   Input XML is written to its stdin, killed if it doesn't complete within the timeout
+#   Time spent starting it and reading its output is added to the phases
+def wsmanpages(cmd, wsreq, inputxml=""):
+	timeout = wsreq["timeout"]
+	phases = wsreq["phases"]
+
+	start = time.time()
+	stdin = None
+	if inputxml and not "win" in sys.platform:
+		stdin = subprocess.PIPE
+
+	if not "win" in sys.platform:
+		# Own process group so that wsman is killed along with the shell
+		proc = subprocess.Popen(cmd, shell=True, bufsize=-1, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+	else:
+		proc = subprocess.Popen(cmd, shell=True, bufsize=-1, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	pipe = proc.stdout
+
+	# Writing the input counts towards the timeout
+	expired = []
+	timer = None
+	if timeout:
+		def expire():
+			expired.append(True)
+			killproc(proc)
+		timer = threading.Timer(timeout, expire)
+		timer.setDaemon(True)
+		timer.start()
+
+	if stdin != None:
+		try:
+			proc.stdin.write(inputxml)
+			proc.stdin.close()
+		except IOError:
+			# Exited or killed without reading it, error is in the output
+			pass
+
+	addphase(phases, "connect", time.time() - start)
+
+	page = []
+	phase = "wait"
+	start = time.time()
+	complete = False
+	try:
+		for line in iter(pipe.readline, ""):
+			# Time taken by the caller between pages isn't counted
+			addphase(phases, phase, time.time() - start)
+			phase = "transfer"
+
+			if len(page) and re.match('\s*<\?xml version=.*?>', line) != None:
+				yield "".join(page)
+				page = []
+			page.append(line)
+			start = time.time()
+		complete = True
+	finally:
+		if timer != None:
+			timer.cancel()
+		if not complete:
+			# Caller stopped reading
+			killproc(proc)
+		pipe.close()
+		proc.wait()
+
+	if len(expired):
+		# Partial page is dropped
+		wsreq["failed"] = True
+		yield "Timed out after %d seconds\n" % timeout
+	elif len(page):
+		yield "".join(page)
 
 def runmethod(cmd):
 	global OUTPUT
+	global PHASES
 
 	ops = []
 	met = []
@@ -9762,7 +12239,9 @@ def runmethod(cmd):
 			j += 1
 
 	ran = False
+	start = time.time()
 	cmd = " ".join([quote_string(replvars(i)) for i in met])
+	PHASES = {"vars": time.time() - start}
 	if len(grops):
 		for op in grops:
 			if op[0] == '{':
@@ -9862,11 +12341,15 @@ def process(cmd):
 			fcmd = "If %s" % cmd[1:]
 		elif cmd[0] == "<":
 			if cmd[1] == "<":
-				if len(acmd[1]) < 5 or acmd[1][0:2] != "//":
-					help("help report")
-					print "\nReport syntax error"
-					return False
-				fcmd = "Report %s where %s" % (acmd[0][2:], acmd[1][2:])
+				# //Field=Value clauses are where clauses, rest are passed on
+				fcmd = "Report %s" % acmd[0][2:]
+				clause = "where"
+				for arg in acmd[1:]:
+					if arg[:2] == "//":
+						fcmd += " %s %s" % (clause, quote_string(arg[2:]))
+						clause = "and"
+					else:
+						fcmd += " " + quote_string(arg)
 			else:
 				fcmd = "Print %s" % cmd[1:]
 		elif cmd[:2] == "//":
@@ -9890,7 +12373,7 @@ def full_process(cmd):
 		ignoreRet = True
 
 	if VARIABLES[VERBOSE] > VERBOSE_WSMAN:
-		print "%s: %s" % (time.ctime(), securecmd(cmd).replace("\\\\", "\\"))
+		print >> echoout(), "%s: %s" % (time.ctime(), securecmd(cmd).replace("\\\\", "\\"))
 
 	lcmd = cmd.lower().split(" ")[0]
 	if "quit" == lcmd or "exit" == lcmd:
@@ -9921,6 +12404,11 @@ def full_process(cmd):
 		help(cmd)
 	elif "log" == lcmd:
 		ret = log(cmd)
+	elif "parallel" == lcmd:
+		ret = parallel(cmd)
+	elif "endparallel" == lcmd:
+		print "\nEndParallel without Parallel"
+		ret = None
 	elif "print" == lcmd:
 		ret = printcmd(cmd)
 	elif "report" == lcmd:
@@ -9947,9 +12435,9 @@ def full_process(cmd):
 	if ret == None:
 		ret = False
 	elif ret == False:
-		if VAR_BATCHFILE in VARIABLES: print "%s:" % VARIABLES[VAR_BATCHFILE],
-		if VAR_LINE in VARIABLES: print "\b%d -" % VARIABLES[VAR_LINE],
-		if VERBOSE in VARIABLES and VARIABLES[VERBOSE] > VERBOSE_QUIET: print "%s failed" % method.replace("\\\\", "\\")
+		if VAR_BATCHFILE in VARIABLES: print >> echoout(), "%s:" % VARIABLES[VAR_BATCHFILE],
+		if VAR_LINE in VARIABLES: print >> echoout(), "\b%d -" % VARIABLES[VAR_LINE],
+		if VERBOSE in VARIABLES and VARIABLES[VERBOSE] > VERBOSE_QUIET: print >> echoout(), "%s failed" % method.replace("\\\\", "\\")
 	elif ret:
 		ret = True
 
@@ -10033,6 +12521,9 @@ def batch(fname, cmds="", sub=None):
 			else:
 				VARIABLES[VAR_LINE] += 1
 
+		# Jump left by a command that failed, not for the next batch run
+		GOTO = None
+
 		if callerline != None:
 			VARIABLES[VAR_LINE] = callerline
 		else:
@@ -10066,7 +12557,6 @@ def interactive():
 def go(cmdline=sys.argv):
 	global CONTEXT_START
 	global CONTEXT_END
-	global TEMPFILES
 	global VARIABLES
 	global VERBOSE
 
@@ -10075,14 +12565,26 @@ def go(cmdline=sys.argv):
 
 	wins = []
 	ret = True
+
+	# Result of the last command run, quit returns None
+	last = True
 	try:
 		# Parse arguments
-		[ips, args, wins, cmds, close, silent, parallel] = parseargs(cmdline)
+		[ips, args, wins, cmds, close, silent, parallel, threaded, adaptive, metrics] = parseargs(cmdline)
+		if metrics:
+			startmetrics(metrics)
 
 		if len(ips) > 1:
+			limiter = None
+			if adaptive:
+				limiter = Limiter(parallel)
+
 			# Multiply since multiple IPs specified
 			try:
-				multiply(ips, args, wins, cmds, close, silent, parallel)
+				if threaded:
+					fanout(ips, args, wins, cmds, silent, parallel, limiter=limiter)
+				else:
+					multiply(ips, args, wins, cmds, close, silent, parallel, limiter=limiter)
 			except KeyboardInterrupt:
 				sys.exit()
 		else:
@@ -10092,6 +12594,7 @@ def go(cmdline=sys.argv):
 				ret = process(cmd)
 				if ret == None:
 					break
+				last = ret
 
 			if ret == True:
 				if not len(wins):
@@ -10100,6 +12603,8 @@ def go(cmdline=sys.argv):
 				else:
 					for win in wins:
 						ret = batch(win)
+						if ret != None:
+							last = ret
 						if ret != True:
 							break
 	except KeyboardInterrupt:
@@ -10107,18 +12612,721 @@ def go(cmdline=sys.argv):
 		if not len(wins):
 			ret = "Loop"
 
-	# Delete all temp files created
-	for fname in TEMPFILES:
-		if VARIABLES[VERBOSE] > VERBOSE_WSMAN:
-			print "Deleting %s" % fname
-		os.unlink(fname)
-	TEMPFILES = []
-
 	# Stop any logging
 	log("Log")
 
+	if ret == None:
+		ret = last
+
 	return ret
 
+###
+# Daemon
+
+# Session output sent to the client as it is printed
+class FrameWriter(object):
+	def __init__(self, sock):
+		self.sock = sock
+
+	def write(self, data):
+		# Parsed responses are unicode, frames are bytes
+		if isinstance(data, unicode):
+			data = data.encode("utf-8")
+		if len(data):
+			sendframe(self.sock, FRAME_OUTPUT, data)
+
+	def flush(self):
+		pass
+
+# Run a client command line in a new session, same order as go()
+def serveclient(sock):
+	writer = FrameWriter(sock)
+	session = Session(stdout=writer)
+	ret = True
+
+	# Result of the last command run, quit returns None
+	last = True
+	try:
+		kind, data = recvframe(sock)
+		if kind != FRAME_ARGS:
+			return
+
+		cmdline = [i for i in data.split("\0") if len(i)]
+		[ips, args, wins, cmds, close, silent, parallel, threaded, adaptive, metrics] = session.run(parseargs, cmdline)
+
+		if len(ips) > 1:
+			limiter = None
+			if adaptive:
+				limiter = Limiter(parallel)
+
+			# Hosts always run as threads, there are no windows to spawn from the daemon
+			fanout(ips, args, wins, cmds, silent, parallel, writer, limiter)
+		else:
+			session.run(loadargs, args)
+			for cmd in cmds:
+				ret = session.run(cmd)
+				if ret == None:
+					break
+				last = ret
+
+			if ret == True:
+				if not len(wins):
+					# Interactive mode, commands come from the client
+					while True:
+						sendframe(sock, FRAME_PROMPT)
+						kind, cmd = recvframe(sock)
+						if kind != FRAME_COMMAND:
+							ret = None
+							break
+						ret = session.run(cmd)
+						if ret == None:
+							break
+						last = ret
+				else:
+					for win in wins:
+						ret = session.run(batch, win)
+						if ret != None:
+							last = ret
+						if ret != True:
+							break
+
+			# Stop any logging
+			session.run(log, "Log")
+
+		sendframe(sock, FRAME_RETURN, str(last))
+	except SystemExit:
+		pass
+	except socket.error:
+		# Client went away
+		pass
+	finally:
+		sock.close()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		if self.path != "/metrics":
+			self.send_error(404)
+			return
+
+		data = METRICS.render()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+# Keep a warm Recite listening on a local socket, see client() for the other end
+#   recite.py --serve /path/to.sock [-mPORT] [NAME=VALUE ...]
+def serve(cmdline=sys.argv):
+	cmdline = cmdline[1:]
+	i = cmdline.index("--serve")
+	if i + 1 >= len(cmdline):
+		print "Usage: recite.py --serve /path/to.sock [NAME=VALUE ...]"
+		return
+	path = cmdline[i + 1]
+
+	if not hasattr(socket, "AF_UNIX"):
+		print "--serve requires Unix domain sockets"
+		return
+
+	# Defaults for every client session
+	[ips, args, wins, cmds, close, silent, parallel, threaded, adaptive, metrics] = parseargs(cmdline[:i] + cmdline[i + 2:])
+	loadargs(args)
+
+	# Metrics of all clients on http://localhost:PORT/metrics
+	if metrics:
+		try:
+			startmetrics()
+			httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", int(metrics)), MetricsHandler)
+		except Exception, e:
+			print "Unable to serve metrics on port %s: %s" % (metrics, e)
+			return
+
+		thread = threading.Thread(target=httpd.serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+		print "Metrics on http://127.0.0.1:%d/metrics" % int(metrics)
+
+	# Remove socket left behind by a previous daemon, nothing else
+	if os.path.lexists(path):
+		if not stat.S_ISSOCK(os.lstat(path).st_mode):
+			print "%s exists and is not a socket" % path
+			return
+		os.unlink(path)
+
+	# Only this user can connect, clients run commands with the daemon's credentials
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	umask = os.umask(0077)
+	try:
+		server.bind(path)
+	finally:
+		os.umask(umask)
+	os.chmod(path, 0600)
+	server.listen(64)
+	print "Listening on %s" % path
+
+	try:
+		while True:
+			sock, addr = server.accept()
+			thread = threading.Thread(target=serveclient, args=(sock,))
+			thread.setDaemon(True)
+			thread.start()
+	except KeyboardInterrupt:
+		pass
+
+	server.close()
+	os.unlink(path)
+
+###
+# Mock server
+
+# Properties of the n-th instance of a class
+def mockinstance(_class, n):
+	fqdd = "%s.Embedded.%d" % (_class.replace("DCIM_", "").replace("View", ""), n + 1)
+	# Attributes all belong to the one device
+	if _class.endswith("Enumeration") or _class.endswith("Attribute") or _class.endswith("Integer") or _class.endswith("String"):
+		fqdd = "%s.Embedded.1" % _class.replace("DCIM_", "")
+
+	if _class.endswith("Enumeration") or _class.endswith("Attribute"):
+		return [
+			("AttributeDisplayName", "Attribute %d" % n),
+			("AttributeName", "Attribute%d" % n),
+			("CurrentValue", ["Enabled", "Disabled"][n % 2]),
+			("DefaultValue", "Enabled"),
+			("FQDD", fqdd),
+			("InstanceID", "%s:Attribute%d" % (fqdd, n)),
+			("IsReadOnly", "false"),
+			("PossibleValues", "Enabled"),
+			("PossibleValues", "Disabled")
+		]
+	elif _class.endswith("Integer"):
+		return [
+			("AttributeName", "Attribute%d" % n),
+			("CurrentValue", n),
+			("FQDD", fqdd),
+			("InstanceID", "%s:Attribute%d" % (fqdd, n)),
+			("LowerBound", 0),
+			("UpperBound", 65535)
+		]
+	elif _class.endswith("String"):
+		return [
+			("AttributeName", "Attribute%d" % n),
+			("CurrentValue", "Value %d" % n),
+			("FQDD", fqdd),
+			("InstanceID", "%s:Attribute%d" % (fqdd, n)),
+			("MaxLength", 64),
+			("MinLength", 0)
+		]
+
+	return [
+		("ElementName", "%s %d" % (_class, n)),
+		("FQDD", fqdd),
+		("InstanceID", fqdd),
+		("Name", fqdd),
+		("PrimaryStatus", 1)
+	]
+
+# Instance as it appears in a response
+def mockproperties(_class, instance, indent):
+	lines = ["%s<n1:%s>" % (indent, _class)]
+	for name, value in instance:
+		lines.append("%s  <n1:%s>%s</n1:%s>" % (indent, name, xml.sax.saxutils.escape(str(value)), name))
+	lines.append("%s</n1:%s>" % (indent, _class))
+	return "\n".join(lines)
+
+# iDRAC/CMC stand-in with made up instances of any class that is asked for
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, instances, delay, jobtime, login, password):
+		BaseHTTPServer.HTTPServer.__init__(self, address, MockHandler)
+		self.instances = instances
+		self.delay = delay
+		self.jobtime = jobtime
+		self.auth = "Basic %s" % base64.b64encode("%s:%s" % (login, password))
+		self.lock = threading.Lock()
+		self.contexts = {}
+		self.jobs = {}
+
+	# Job state moves along with the time since it was created
+	def job(self, jid):
+		elapsed = time.time() - self.jobs[jid][1]
+		if elapsed < self.jobtime / 3.0:
+			status, percent, message = "Scheduled", 0, "Task successfully scheduled."
+		elif elapsed < self.jobtime:
+			status, percent, message = "Running", int(100 * elapsed / self.jobtime), "Job in progress."
+		else:
+			status, percent, message = "Completed", 100, "Job completed successfully."
+
+		return [
+			("InstanceID", jid),
+			("JobStartTime", "TIME_NOW"),
+			("JobStatus", status),
+			("JobUntilTime", "TIME_NA"),
+			("Message", message),
+			("MessageID", "JCP%03d" % percent),
+			("Name", self.jobs[jid][0]),
+			("PercentComplete", percent)
+		]
+
+	def newjob(self, name):
+		self.lock.acquire()
+		try:
+			jid = "JID_%012d" % (len(self.jobs) + 1)
+			self.jobs[jid] = (name, time.time())
+		finally:
+			self.lock.release()
+		return jid
+
+	def instances_of(self, _class):
+		if _class == "DCIM_LifecycleJob":
+			jids = self.jobs.keys()
+			jids.sort()
+			return [self.job(jid) for jid in jids]
+		return [mockinstance(_class, n) for n in range(self.instances)]
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+		if self.headers.getheader("Authorization") != self.server.auth:
+			self.reply(401, "", [("WWW-Authenticate", 'Basic realm="WSMAN"')])
+			return
+
+		if self.server.delay:
+			time.sleep(self.server.delay)
+
+		try:
+			request = xml.dom.minidom.parseString(body)
+		except:
+			self.reply(400, self.fault("", "", "wsman:SchemaValidationError", "Request is not valid XML"))
+			return
+
+		if len(request.getElementsByTagNameNS("*", "Identify")):
+			self.reply(200, MOCKIDENTIFY)
+			return
+
+		action = self.text(request, "Action")
+		resource = self.text(request, "ResourceURI")
+		messageid = self.text(request, "MessageID")
+		_class = resource.split("?")[0].split("/")[-1]
+		selectors = {}
+		for selector in request.getElementsByTagNameNS("*", "Selector"):
+			selectors[selector.getAttribute("Name")] = getNodeText(selector.childNodes)
+
+		if action == ACTION_GET:
+			instances = self.server.instances_of(_class)
+			if "InstanceID" in selectors:
+				matches = [i for i in instances if dict(i).get("InstanceID") == selectors["InstanceID"]]
+				# Any other InstanceID is made up on the spot, except for jobs
+				if not len(matches) and len(instances) and _class != "DCIM_LifecycleJob":
+					instanceid = selectors["InstanceID"]
+					matches = [[(name, {"InstanceID": instanceid, "AttributeName": instanceid.split(":")[-1]}.get(name, value)) for name, value in instances[0]]]
+				instances = matches
+			if not len(instances):
+				self.reply(400, self.fault(resource, messageid, "wsman:InvalidSelectors", "The Selectors for the resource were not valid."))
+				return
+			self.reply(200, self.envelope(resource, action, messageid, mockproperties(_class, instances[0], "    ")))
+
+		elif action == ACTION_PUT:
+			# Echo the instance back
+			instance = request.getElementsByTagNameNS(SOAPENV, "Body")[0]
+			self.reply(200, self.envelope(resource, action, messageid, "".join([i.toxml() for i in instance.childNodes])))
+
+		elif action == ACTION_ENUMERATE:
+			if len(request.getElementsByTagNameNS("*", "EnumerationMode")):
+				# Services and systems are singletons
+				items = [self.epr(resource, _class)]
+			else:
+				items = [mockproperties(_class, i, "      ") for i in self.server.instances_of(_class)]
+
+			maxelements = 0
+			if len(request.getElementsByTagNameNS("*", "OptimizeEnumeration")):
+				maxelements = int(self.text(request, "MaxElements") or 1)
+			context, page, end = self.page(items, maxelements)
+
+			response = "    <wsen:EnumerateResponse>\n"
+			if context != None:
+				response += "      <wsen:EnumerationContext>%s</wsen:EnumerationContext>\n" % context
+			if maxelements:
+				response += "      <wsman:Items>\n%s\n      </wsman:Items>\n" % page
+				if end:
+					response += "      <wsman:EndOfSequence/>\n"
+			response += "    </wsen:EnumerateResponse>"
+			self.reply(200, self.envelope(resource, action + "Response", messageid, response))
+
+		elif action == ACTION_PULL:
+			self.server.lock.acquire()
+			try:
+				items = self.server.contexts.pop(self.text(request, "EnumerationContext"), None)
+			finally:
+				self.server.lock.release()
+			if items == None:
+				self.reply(400, self.fault(resource, messageid, "wsen:InvalidEnumerationContext", "The supplied enumeration context is invalid."))
+				return
+
+			context, page, end = self.page(items, int(self.text(request, "MaxElements") or 1))
+			response = "    <wsen:PullResponse>\n"
+			if context != None:
+				response += "      <wsen:EnumerationContext>%s</wsen:EnumerationContext>\n" % context
+			response += "      <wsen:Items>\n%s\n      </wsen:Items>\n" % page
+			if end:
+				response += "      <wsen:EndOfSequence/>\n"
+			response += "    </wsen:PullResponse>"
+			self.reply(200, self.envelope(resource, action + "Response", messageid, response))
+
+		elif action.startswith(resource.split("?")[0] + "/"):
+			method = action.split("/")[-1]
+			output = []
+			if method.startswith("Get"):
+				output.append("      <n1:Status>Ready</n1:Status>")
+				output.append("      <n1:ReturnValue>0</n1:ReturnValue>")
+			else:
+				jid = self.server.newjob(method)
+				epr = MOCKEPR % ("http://schemas.dell.com/wbem/wscim/1/cim-schema/2/DCIM_LifecycleJob", "\n".join([MOCKSELECTOR % ("InstanceID", jid), MOCKSELECTOR % ("__cimnamespace", "root/dcim")]))
+				output.append("      <n1:Job>\n%s\n      </n1:Job>" % epr)
+				output.append("      <n1:ReturnValue>4096</n1:ReturnValue>")
+			response = "    <n1:%s_OUTPUT>\n%s\n    </n1:%s_OUTPUT>" % (method, "\n".join(output), method)
+			self.reply(200, self.envelope(resource, action, messageid, response))
+
+		else:
+			self.reply(400, self.fault(resource, messageid, "wsa:ActionNotSupported", "The action is not supported by the service."))
+
+	# Up to maxelements items, the rest are kept for Pull under a new context
+	def page(self, items, maxelements):
+		page = items[:maxelements]
+		rest = items[maxelements:]
+		context = None
+		if maxelements == 0 or len(rest):
+			context = "uuid:%s" % uuid.uuid4()
+			self.server.lock.acquire()
+			try:
+				self.server.contexts[context] = rest
+			finally:
+				self.server.lock.release()
+		return context, "\n".join(page), maxelements != 0 and not len(rest)
+
+	def epr(self, resource, _class):
+		selectors = [
+			("CreationClassName", _class),
+			("Name", "DCIM:%s" % _class.replace("DCIM_", "")),
+			("SystemCreationClassName", "DCIM_ComputerSystem"),
+			("SystemName", "DCIM:ComputerSystem"),
+			("__cimnamespace", "root/dcim")
+		]
+		return MOCKEPR % (resource.split("?")[0], "\n".join([MOCKSELECTOR % s for s in selectors]))
+
+	def envelope(self, resource, action, messageid, body):
+		return MOCKENVELOPE % (resource.split("?")[0], action, messageid, uuid.uuid4(), body)
+
+	def fault(self, resource, messageid, subcode, reason):
+		return self.envelope(resource, "http://schemas.dmtf.org/wbem/wsman/1/wsman/fault", messageid, MOCKFAULT % (subcode, reason))
+
+	def text(self, request, name):
+		elements = request.getElementsByTagNameNS("*", name)
+		if not len(elements):
+			return ""
+		return getNodeText(elements[0].childNodes).strip()
+
+	def reply(self, status, data, headers=[]):
+		self.send_response(status)
+		self.send_header("Content-Type", "application/soap+xml;charset=UTF-8")
+		self.send_header("Content-Length", str(len(data)))
+		for header in headers:
+			self.send_header(*header)
+		self.end_headers()
+		self.wfile.write(data)
+
+# Serve made up WS-MAN responses over HTTPS for testing without an iDRAC
+#   recite.py --mock-server [PORT] [instances=N] [delay=SECONDS] [jobtime=SECONDS]
+#     [cert=FILE key=FILE] [bind=ADDRESS] [LOGIN=username] [PASS=password]
+#   Only local clients can connect unless bind is given, it accepts default credentials
+def mockserver(cmdline=sys.argv):
+	cmdline = cmdline[1:]
+	i = cmdline.index("--mock-server")
+	cmdline = cmdline[i + 1:]
+
+	port = MOCKPORTDEFAULT
+	options = {
+		"instances": MOCKINSTANCESDEFAULT,
+		"delay": 0,
+		"jobtime": MOCKJOBDEFAULT,
+		"cert": None,
+		"key": None,
+		"bind": MOCKBINDDEFAULT,
+		"LOGIN": VARIABLES[LOGIN],
+		"PASS": VARIABLES[PASS]
+	}
+	try:
+		for arg in cmdline:
+			arg = arg.split("=", 1)
+			if len(arg) == 1:
+				port = int(arg[0])
+			elif arg[0] in ["instances", "jobtime"]:
+				options[arg[0]] = int(arg[1])
+			elif arg[0] == "delay":
+				options[arg[0]] = float(arg[1])
+			elif arg[0] in options:
+				options[arg[0]] = arg[1]
+			else:
+				raise ValueError
+	except:
+		print "Usage: recite.py --mock-server [PORT] [instances=N] [delay=SECONDS] [jobtime=SECONDS] [cert=FILE key=FILE] [bind=ADDRESS] [LOGIN=username] [PASS=password]"
+		return
+
+	if ssl == None:
+		print "--mock-server requires the Python ssl module"
+		return
+
+	# Self-signed certificate unless one is provided
+	tempdir = None
+	if options["cert"] == None:
+		tempdir = tempfile.mkdtemp()
+		options["cert"] = os.path.join(tempdir, "cert.pem")
+		options["key"] = os.path.join(tempdir, "key.pem")
+		ret = subprocess.call("openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=localhost -keyout \"%s\" -out \"%s\"" % (options["key"], options["cert"]), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		if ret != 0:
+			print "Unable to create a certificate with openssl, specify cert=FILE key=FILE"
+			shutil.rmtree(tempdir)
+			return
+
+	try:
+		server = MockServer((options["bind"], port), options["instances"], options["delay"], options["jobtime"], options["LOGIN"], options["PASS"])
+		server.socket = ssl.wrap_socket(server.socket, certfile=options["cert"], keyfile=options["key"], server_side=True)
+	except Exception, e:
+		print "Unable to start mock server on port %d: %s" % (port, e)
+		if tempdir != None:
+			shutil.rmtree(tempdir)
+		return
+
+	print "Mock server listening on %s port %d, %d instances per class" % (options["bind"], port, options["instances"])
+	try:
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+	finally:
+		server.server_close()
+		if tempdir != None:
+			shutil.rmtree(tempdir)
+
+###
+# Benchmarks
+
+# Optimized enumeration of made up instances as it comes back from the iDRAC
+def benchpages(_class, instances, maxelements):
+	resource = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/root/dcim/%s" % _class
+
+	pages = []
+	for start in range(0, instances, maxelements):
+		end = min(instances, start + maxelements)
+		items = [mockproperties(_class, mockinstance(_class, n), "        ") for n in range(start, end)]
+		response = "    <wsen:PullResponse>\n      <wsen:Items>\n%s\n      </wsen:Items>\n" % "\n".join(items)
+		if end == instances:
+			response += "      <wsen:EndOfSequence/>\n"
+		response += "    </wsen:PullResponse>"
+		pages.append(MOCKENVELOPE % (resource, ACTION_PULL + "Response", "uuid:%s" % uuid.uuid4(), uuid.uuid4(), response))
+
+	return pages
+
+# Calls per second, fn is called for at least seconds with its output discarded
+def benchrate(fn, seconds):
+	stdout = sys.stdout
+	sys.stdout = StringIO.StringIO()
+	try:
+		calls = 0
+		start = time.time()
+		while True:
+			fn()
+			calls += 1
+			elapsed = time.time() - start
+			if elapsed >= seconds:
+				return calls / elapsed
+	finally:
+		sys.stdout = stdout
+
+# Calls per second and how far memory peaked above what was in use before in MB
+#   Each benchmark runs in a child process so that its peak is its own, peak is
+#   None where there is no fork()
+def benchone(fn, seconds):
+	if not hasattr(os, "fork") or resource == None:
+		return benchrate(fn, seconds), None
+
+	sys.stdout.flush()
+	(reader, writer) = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		try:
+			os.close(reader)
+			start = peakmemory()
+			rate = benchrate(fn, seconds)
+			os.write(writer, json.dumps([rate, peakmemory() - start]))
+		finally:
+			os._exit(0)
+
+	os.close(writer)
+	data = []
+	while True:
+		chunk = os.read(reader, 4096)
+		if not chunk:
+			break
+		data.append(chunk)
+	os.close(reader)
+	os.waitpid(pid, 0)
+
+	if not len(data):
+		raise Exception("Benchmark exited without a result")
+	return json.loads("".join(data))
+
+# Peak memory of the process so far in MB
+def peakmemory():
+	if resource == None:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		# Bytes instead of KB
+		return peak / 1048576.0
+	return peak / 1024.0
+
+# Time the hot paths against large canned responses, results are compared with
+# and saved to benchmarks/baseline.json next to recite.py
+#   recite.py --bench [save] [instances=N] [seconds=S]
+def bench(cmdline=sys.argv):
+	cmdline = cmdline[1:]
+	i = cmdline.index("--bench")
+	cmdline = cmdline[i + 1:]
+
+	save = False
+	instances = BENCHINSTANCES
+	seconds = BENCHSECONDS
+	try:
+		for arg in cmdline:
+			arg = arg.split("=", 1)
+			if arg[0] == "save" and len(arg) == 1:
+				save = True
+			elif arg[0] == "instances":
+				instances = int(arg[1])
+			elif arg[0] == "seconds":
+				seconds = float(arg[1])
+			else:
+				raise ValueError
+	except:
+		print "Usage: recite.py --bench [save] [instances=N] [seconds=S]"
+		return
+
+	filename = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "benchmarks", "baseline.json")
+	baseline = None
+	try:
+		fp = open(filename)
+		baseline = json.load(fp)
+		fp.close()
+		if baseline["instances"] != instances:
+			print "Baseline in %s is for %d instances, not comparing" % (filename, baseline["instances"])
+			baseline = None
+	except IOError:
+		save = True
+	except (ValueError, KeyError):
+		print "Invalid baseline %s, not comparing" % filename
+
+	# Own session so that the variables and output of the caller are left as they were
+	results = Session().run(benchall, instances, seconds, baseline)
+
+	if save:
+		directory = os.path.dirname(filename)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		fp = open(filename, "w")
+		json.dump({
+			"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+			"python": sys.version.split()[0],
+			"instances": instances,
+			"results": results
+		}, fp, indent=1, sort_keys=True)
+		fp.close()
+		print "\nBaseline saved to %s" % filename
+
+# Run the benchmarks, returns their results
+def benchall(instances, seconds, baseline):
+	global VARIABLES
+
+	# Responses come from a recording, GetBIOSEnumerations is paged as on the iDRAC
+	tempdir = tempfile.mkdtemp()
+	command = "GetBIOSEnumerations"
+	for page in recordpages(iter(benchpages("DCIM_BIOSEnumeration", instances, 100)), os.path.join(tempdir, cassettename(command)), command, "", ""):
+		pass
+
+	setvar("Set %s 10.0.0.1" % IP)
+	setvar("Set %s %d" % (VERBOSE, VERBOSE_QUIET))
+	VARIABLES[REPLAY] = tempdir
+
+	run(command)
+	outputtree = OUTPUTTREE
+	instanceid = "BIOSEnumeration.Embedded.1:Attribute%d" % (instances - 1)
+
+	variables = ["$BENCH%d" % i for i in range(BENCHVARIABLES)]
+	line = " ".join(variables[::10])
+
+	def replvars_many():
+		for var in variables:
+			VARIABLES[var] = var[1:].lower()
+		try:
+			return replvars(line)
+		finally:
+			for var in variables:
+				del VARIABLES[var]
+
+	def build(command):
+		cmd, method, wsreq = buildcmd(command)
+		removeinput(wsreq)
+		return cmd
+
+	tests = [
+		("buildcmd get", lambda: build("GetBIOSEnumeration InstanceID=BIOS.Setup.1-1:NumLock")),
+		("buildcmd invoke", lambda: build("SetBIOSAttributes Target=BIOS.Setup.1-1 AttributeName=NumLock AttributeValue=On AttributeName=IpVer AttributeValue=IPv4")),
+		("run", lambda: run(command)),
+		("xmltoplain", lambda: xmltoplain(outputtree)),
+		("findall", lambda: findall("Findall CurrentValue $BENCH")),
+		("find", lambda: find("Find InstanceID=%s $BENCH" % instanceid)),
+		("report", lambda: report("Report * where CurrentValue=Disabled")),
+		("replvars", replvars_many),
+		("expandipfile", lambda: expandipfile([BENCHRANGE]))
+	]
+
+	print "%d instances, %s for expandipfile, %d variables for replvars\n" % (instances, BENCHRANGE, BENCHVARIABLES)
+	print "%-16s %12s %10s %10s" % ("Benchmark", "ops/sec", "peak MB", "baseline")
+	print "%-16s %12s %10s %10s" % ("-" * 16, "-" * 12, "-" * 10, "-" * 10)
+
+	results = {}
+	try:
+		for name, fn in tests:
+			rate, peak = benchone(fn, seconds)
+			results[name] = {"ops": rate, "peak": peak}
+
+			change = ""
+			if baseline != None and name in baseline["results"]:
+				before = baseline["results"][name]["ops"]
+				change = "%+.1f%%" % ((rate - before) * 100 / before)
+				if rate < before * (1 - BENCHTOLERANCE):
+					change += " REGRESSION"
+			if peak == None:
+				peak = "-"
+			else:
+				peak = "%.1f" % peak
+			print "%-16s %12.3f %10s %10s" % (name, rate, peak, change)
+	finally:
+		shutil.rmtree(tempdir)
+
+	return results
+
 ###
 # API
 
@@ -10150,6 +13358,11 @@ def get_inputxml():
 
 def get_output():
 	global OUTPUT
+	global OUTPUTTREE
+
+	# Plain text is only rendered once asked for
+	if OUTPUT == None:
+		OUTPUT = plaintext(OUTPUTTREE)
 
 	return OUTPUT
 
@@ -10162,12 +13375,21 @@ def get_outputxmlobj(exit=True):
 	global OUTPUT
 	global OUTPUTXML
 	global OUTPUTXMLOBJ
+	global OUTPUTTREE
+	global OUTPUTPAGES
 
 	if OUTPUTXMLOBJ != None:
 		return OUTPUTXMLOBJ
 
 	try:
-		OUTPUTXMLOBJ = xml.dom.minidom.parseString(OUTPUTXML)
+		if OUTPUTXML == "" and OUTPUTTREE != None:
+			# Still streaming, pages so far
+			if len(OUTPUTPAGES) == 1:
+				OUTPUTXMLOBJ = xml.dom.minidom.parseString(OUTPUTPAGES[0])
+			else:
+				OUTPUTXMLOBJ = xml.dom.minidom.parseString("<Results>" + "".join(OUTPUTPAGES) + "</Results>")
+		else:
+			OUTPUTXMLOBJ = xml.dom.minidom.parseString(OUTPUTXML)
 	except:
 		if exit:
 			print "Failed\n\n----- ERROR -----\n%s\n-----------------" % OUTPUT
@@ -10177,23 +13399,66 @@ def get_outputxmlobj(exit=True):
 
 	return OUTPUTXMLOBJ
 
+# Run method, yields the parsed XML object of each response page as it arrives
+def stream(cmd):
+	cmd = " ".join([quote_string(replvars(i)) for i in shlex.split(cmd)])
+
+	def pageobjs(pages):
+		try:
+			for page in pages:
+				if page != None:
+					page = xml.dom.minidom.parseString(page)
+				yield page
+		finally:
+			pages.close()
+
+	return pageobjs(runpages(cmd))
+
 def get_curr_scriptpath():
 	if VAR_BATCHFILE in VARIABLES:
 		return VARIABLES[VAR_BATCHFILE]
 	else:
 		return ""
 
-def set_logfile(filename=None):
+# Trace every WS-MAN command to filename as JSON lines, payload adds the command,
+# input and output XML to each record
+def set_logfile(filename=None, payload=True):
 	global LOGFILE
 
+	if LOGFILE != None:
+		LOGFILE.close()
+
 	if filename:
-		LOGFILE = filename
+		LOGFILE = TraceWriter(filename, payload)
 	else:
 		LOGFILE = None
 
+# Trace still open on exit has its last records written
+def closelogfile():
+	if LOGFILE != None:
+		LOGFILE.close()
+
+atexit.register(closelogfile)
+
 if __name__ == "__main__":
+	if "--serve" in sys.argv:
+		serve()
+		sys.exit()
+
+	if "--mock-server" in sys.argv:
+		mockserver()
+		sys.exit()
+
+	if "--bench" in sys.argv:
+		bench()
+		sys.exit()
+
 	# In interactive mode, only exits when you "quit"
 	while True:
 		ret = go()
 		if ret != "Loop":
 			break
+
+	# Exit code tells whoever started this instance, such as multiply(), if it failed
+	if ret == False:
+		sys.exit(1)